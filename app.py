@@ -1,16 +1,73 @@
 import os
 import logging
 import secrets
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, jsonify
 from werkzeug.utils import secure_filename
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 
-from find_closest_posts import get_closest_posts_plot_html
+from search_index import FACET_FIELDS, SearchIndex
+from cache import LRUCache
+from store import ChangeLogPruner, Store
+from storage import SQLiteStorage, import_tsv
+from attachments import AttachmentReconciler
+from chunked_uploads import UploadError, UploadSessions
+from previews import PreviewError, can_preview, get_preview
+from datasets import DatasetError, ingest, ingestible, is_ingested, query_aggregates, query_rows
+from similarity import SimilarityService, SimilarityUnavailable
+import instrumentation
+from instrumentation import span
+
+
+def load_secret_key(path):
+    """
+    The session signing key: SECRET_KEY from the environment, or one generated on first start
+    and kept in path, so sessions survive restarts and are valid in every worker process.
+    """
+    if os.environ.get('SECRET_KEY'):
+        return os.environ['SECRET_KEY']
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, 'rb') as f:
+            return f.read()
+    key = secrets.token_bytes(32)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
 
 app = Flask(__name__)
-app.secret_key = secrets.token_bytes(16)
+app.config['SECRET_KEY_FILE'] = 'secret_key'
+app.secret_key = load_secret_key(app.config['SECRET_KEY_FILE'])
 app.config['UPLOAD_FOLDER'] = 'uploads/'
+app.config['DATABASE'] = 'broad_atlas.db'
+# Single-request bodies are capped, larger files go through the chunked /uploads API
+app.config['MAX_CONTENT_LENGTH'] = 1024 ** 3
+app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 ** 2
+app.config['MAX_UPLOAD_SIZE'] = 50 * 1024 ** 3
+# Chunked uploads that received nothing for this many seconds are deleted
+app.config['UPLOAD_SESSION_MAX_AGE'] = 24 * 3600
+# Let the front-end server send attachments: USE_X_SENDFILE for Apache/lighttpd, or the internal
+# location uploads are served from for nginx's X-Accel-Redirect, e.g. '/protected-uploads/'
+app.config['USE_X_SENDFILE'] = False
+app.config['X_ACCEL_REDIRECT_PREFIX'] = None
+# How often to pick up files added to the upload folder by hand, in seconds
+app.config['ATTACHMENT_RECONCILE_INTERVAL'] = 300
+# How often each process reports how far it synced and prunes the changes all processes replayed, in seconds
+app.config['CHANGE_LOG_PRUNE_INTERVAL'] = 60
+app.config['POSTS_PER_PAGE'] = 20
+# Upper bound on the page size a client can ask for, which bounds the work done per request
+app.config['MAX_POSTS_PER_PAGE'] = 100
+# How often to check for posts without embeddings and whether the embeddings need a refit, in seconds
+app.config['EMBEDDING_UPDATE_INTERVAL'] = 60
+# Opt-in latency metrics at /metrics, see instrumentation.py
+app.config['INSTRUMENTATION'] = os.environ.get('INSTRUMENTATION') == '1'
+# Bearer token scrapers send for /metrics, without one only local requests are answered
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# With instrumentation on, requests slower than this many seconds are profiled into PROFILE_PATH as folded stacks
+app.config['PROFILE_SLOW_REQUESTS'] = float(os.environ['PROFILE_SLOW_REQUESTS']) if os.environ.get('PROFILE_SLOW_REQUESTS') else None
+app.config['PROFILE_PATH'] = 'slow_requests.folded'
 app.config['ALLOWED_EXTENSIONS'] = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'edf', 'zip', 'csv', 'fasta', 'hdf5', 'gct', 'tsv', 'h5ad', 'feather', 'parquet', 'vcf', 'bam', 'sam', 'crm', 'tiff', 'xlsx', 'bed'}
 
 logger = logging.getLogger(__name__)
@@ -20,26 +77,69 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(level
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
-
-# In-memory storage for posts, comments, likes, comment likes, and users (for simplicity)
-posts = []
-comments = []
-likes = []
-comment_likes = []
-users = {}
-downloads = {}
+# Registered first so the request timer also covers the handlers below
+instrumentation.init_app(app)
+
+# Posts, comments, likes, comment likes, and users, kept in memory and written through to SQLite
+store = Store(SQLiteStorage(app.config['DATABASE']))
+# Context managers are left alone, a span would only time creating them
+instrumentation.trace_methods(store.backend, 'storage', skip=('connection', 'batch'))
+upload_sessions = UploadSessions(store, app.config['UPLOAD_FOLDER'], app.config['MAX_UPLOAD_SIZE'], app.config['UPLOAD_SESSION_MAX_AGE'])
+# Converts uploaded long-format tables to parquet and precomputes their aggregates off the request thread
+ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest')
+change_log_pruner = ChangeLogPruner(store, app.config['CHANGE_LOG_PRUNE_INTERVAL'])
+reconciler = AttachmentReconciler(store, app.config['UPLOAD_FOLDER'], app.config['ATTACHMENT_RECONCILE_INTERVAL'])
+search_index = SearchIndex(like_count=store.like_count)
+# Closest-posts graph data by post id, cleared whenever the set of posts changes
+closest_posts_cache = LRUCache(maxsize=512, ttl=3600)
+# Closest posts, loaded in the background so startup does not wait for gensim and the embeddings
+similarity = SimilarityService(store.all_posts, store.get_post, app.config['EMBEDDING_UPDATE_INTERVAL'], on_change=closest_posts_cache.clear)
 
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
 def file_info(filename):
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file_size = os.path.getsize(filepath)
-    file_extension = filename.rsplit('.', 1)[1].lower()
-    download_count = downloads.get(filename, 0)
+    # Served from the attachment metadata recorded at upload time, rendering never stats the file
+    attachment = store.attachments.get(filename)
+    file_size = attachment['size'] if attachment else 0
+    file_extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    download_count = store.download_count(filename)
     return file_size, file_extension, download_count
 
+def ingest_in_background(filename):
+    attachment = store.attachments.get(filename)
+    if not attachment or not ingestible(app.config['UPLOAD_FOLDER'], attachment):
+        return None
+    future = ingest_executor.submit(ingest, app.config['UPLOAD_FOLDER'], attachment)
+    future.add_done_callback(lambda f: f.exception() and logger.error("Could not ingest %s: %s", filename, f.exception()))
+    return future
+
+def post_page(args, user_name, page_posts=None):
+    """
+    Read the before/limit cursor from the query string and build the view model for that page
+    of posts: each post gets its comments with like counts, liked-by-me flags and attachment
+    info, so rendering it never touches the rest of the site.
+
+    Pages come from page_posts(before, limit), all posts by default.
+    """
+    before = args.get('before', type=int)
+    limit = args.get('limit', app.config['POSTS_PER_PAGE'], type=int)
+    limit = max(1, min(limit, app.config['MAX_POSTS_PER_PAGE']))
+    page, next_cursor = (page_posts or store.page_posts)(before, limit)
+    views = []
+    for post in page:
+        view = dict(post, likes=store.like_count(post['id']))
+        view['user_id'] = store.user_id_for_name(post['user'])
+        view['liked'] = store.has_liked(post['id'], user_name)
+        view['comments'] = [
+            dict(comment, likes=store.comment_like_count(comment['id']), liked=store.has_liked_comment(comment['id'], user_name))
+            for comment in store.comments_for(post['id'])
+        ]
+        view['file'] = file_info(post['filename']) if post['filename'] else None
+        views.append(view)
+    return views, next_cursor
+
 class User(UserMixin):
     def __init__(self, id, name, job_title, email, department, profile_picture, bio='', research_interests='', website=''):
         self.id = id
@@ -51,16 +151,34 @@ class User(UserMixin):
         self.bio = bio
         self.research_interests = research_interests
         self.website = website
-        self.followers = []
-        self.following = []
+        self.followers = set()
+        self.following = set()
 
 @login_manager.user_loader
 def load_user(user_id):
-    return users.get(user_id)
+    return store.users.get(user_id)
+
+@app.before_request
+def sync_store():
+    # Pick up what other worker processes wrote since this one last served a request
+    with span('store.sync'):
+        changes = store.sync()
+    for kind, item in changes:
+        if kind == 'post':
+            search_index.add_post(item)
+            closest_posts_cache.clear()
+            similarity.notify()
+        elif kind == 'comment':
+            search_index.add_comment(item)
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    if not current_user.is_authenticated:
+        return render_template('index.html')
+    # Posts by the users current_user follows, see timelines.Timelines
+    timeline, next_cursor = post_page(request.args, current_user.name,
+                                      lambda before, limit: store.timeline(current_user.id, before, limit))
+    return render_template('index.html', timeline=timeline, next_cursor=next_cursor)
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -73,17 +191,15 @@ def register():
         research_interests = request.form['research_interests']
         website = request.form['website']
         profile_picture = request.files.get('profile_picture')
-        user_id = str(len(users) + 1)
+        user_id = store.next_user_id()
         if profile_picture and allowed_file(profile_picture.filename):
             filename = secure_filename(profile_picture.filename)
             profile_picture.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
         else:
             filename = None
         new_user = User(user_id, name, job_title, email, department, filename, bio, research_interests, website)
-        users[user_id] = new_user
+        store.add_user(new_user)
         flash('Account created successfully. Please log in.', 'success')
-        with open('users.tsv', 'a') as f:
-            f.write(f"{name}\t{job_title}\t{email}\t{department}\t{filename}\t{bio}\t{research_interests}\t{website}\n")
         return redirect(url_for('login'))
     return render_template('register.html')
 
@@ -91,11 +207,11 @@ def register():
 def login():
     logger.info("Log in request")
     if request.method == 'POST':
-        email = request.form['email']
-        for user_id, user in users.items():
-            if user.email == email:
-                login_user(user)
-                return redirect(url_for('index'))
+        email = request.form['email'].strip()
+        user = store.user_by_email(email) if email else None
+        if user:
+            login_user(user)
+            return redirect(url_for('index'))
         flash('Sorry, we cannot find an account registered with that email', 'error')
     return render_template('login.html')
 
@@ -124,12 +240,18 @@ def upload():
         usage_restrictions = request.form['usage_restrictions']
         related_datasets = request.form['related_datasets']
         link = ""
-        file = request.files['file']
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        file = request.files.get('file')
+        # Files sent ahead through the chunked upload API arrive as the session they were sent in,
+        # which has to be the current user's
+        upload_session_id = request.form.get('upload_session')
+        if upload_session_id:
+            filename = upload_sessions.claim(upload_session_id, current_user.id)
+        elif file and allowed_file(file.filename):
+            filename = upload_sessions.save_stream(file.stream, file.filename)
         else:
             filename = None
+        if filename:
+            ingest_in_background(filename)
         post = {
             'title': title,
             'description': description,
@@ -148,13 +270,51 @@ def upload():
             'link': link,
             'filename': filename,
             'user': current_user.name,
-            'id': len(posts) + 1,
             'likes': 0
         }
-        posts.append(post)
+        post = store.add_post(post)
+        search_index.add_post(post)
+        closest_posts_cache.clear()
+        similarity.notify()
         return redirect(url_for('posts_view'))
     return render_template('results.html')
 
+@app.errorhandler(UploadError)
+def upload_error(error):
+    return jsonify({'error': error.message}), error.status
+
+@app.route('/uploads', methods=['POST'])
+@login_required
+def create_upload_session():
+    data = request.get_json(force=True)
+    filename = data.get('filename', '')
+    if not allowed_file(filename):
+        raise UploadError('File type not allowed.')
+    session = upload_sessions.create(filename, int(data.get('size', -1)), current_user.id)
+    return jsonify({'id': session['id'], 'offset': 0, 'chunk_size': app.config['UPLOAD_CHUNK_SIZE']}), 201
+
+@app.route('/uploads/<session_id>', methods=['GET', 'PUT'])
+@login_required
+def upload_session(session_id):
+    if request.method == 'PUT':
+        # Content-Range: bytes <start>-<end>/<total>
+        content_range = request.headers.get('Content-Range', '')
+        try:
+            start = int(content_range.split()[1].split('-')[0])
+        except (IndexError, ValueError):
+            raise UploadError('A Content-Range header is required.')
+        if (request.content_length or 0) > app.config['UPLOAD_CHUNK_SIZE']:
+            raise UploadError('Chunk is too large.', 413)
+        session = upload_sessions.write_chunk(session_id, current_user.id, start, request.stream)
+    else:
+        session = upload_sessions.status(session_id, current_user.id)
+    return jsonify({'id': session['id'], 'offset': session['offset'], 'size': session['size']})
+
+@app.route('/uploads/<session_id>/complete', methods=['POST'])
+@login_required
+def complete_upload_session(session_id):
+    return jsonify({'filename': upload_sessions.complete(session_id, current_user.id)})
+
 @app.route('/posts', methods=['GET', 'POST'])
 @login_required
 def posts_view():
@@ -162,45 +322,49 @@ def posts_view():
         if 'comment' in request.form:
             post_id = int(request.form['post_id'])
             comment_text = request.form['comment']
-            comment = {'post_id': post_id, 'user': current_user.name, 'text': comment_text, 'id': len(comments) + 1}
-            comments.append(comment)
+            comment = store.add_comment(post_id, current_user.name, comment_text)
+            search_index.add_comment(comment)
         elif 'like' in request.form:
             post_id = int(request.form['post_id'])
-            if not any(like['post_id'] == post_id and like['user'] == current_user.name for like in likes):
-                likes.append({'post_id': post_id, 'user': current_user.name})
-                for post in posts:
-                    if post['id'] == post_id:
-                        post['likes'] += 1
-                        break
+            store.like_post(post_id, current_user.name)
         elif 'like_comment' in request.form:
             comment_id = int(request.form['comment_id'])
-            if not any(like['comment_id'] == comment_id and like['user'] == current_user.name for like in comment_likes):
-                comment_likes.append({'comment_id': comment_id, 'user': current_user.name})
-    return render_template('posts.html', posts=posts, comments=comments, likes=likes, comment_likes=comment_likes, file_info=file_info)
+            store.like_comment(comment_id, current_user.name)
+    page, next_cursor = post_page(request.args, current_user.name)
+    return render_template('posts.html', posts=page, next_cursor=next_cursor)
+
+@app.route('/api/posts')
+@login_required
+def posts_api():
+    page, next_cursor = post_page(request.args, current_user.name)
+    return jsonify({'posts': page, 'next_cursor': next_cursor})
 
 @app.route('/profile')
 @login_required
 def profile():
-    user_posts = [post for post in posts if post['user'] == current_user.name]
-    liked_posts = [post for post in posts if any(like['post_id'] == post['id'] and like['user'] == current_user.name for like in likes)]
-    return render_template('profile.html', user=current_user, posts=user_posts, liked_posts=liked_posts, users=users)
+    user_posts = store.posts_by(current_user.name)
+    liked_posts = store.liked_posts(current_user.name)
+    return render_template('profile.html', user=current_user, posts=user_posts, liked_posts=liked_posts, users=store.users)
 
 @app.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
 def edit_profile():
     if request.method == 'POST':
-        current_user.name = request.form['name']
-        current_user.job_title = request.form['job_title']
-        current_user.email = request.form['email']
-        current_user.department = request.form['department']
-        current_user.bio = request.form['bio']
-        current_user.research_interests = request.form['research_interests']
-        current_user.website = request.form['website']
+        fields = {
+            'name': request.form['name'],
+            'job_title': request.form['job_title'],
+            'email': request.form['email'],
+            'department': request.form['department'],
+            'bio': request.form['bio'],
+            'research_interests': request.form['research_interests'],
+            'website': request.form['website'],
+        }
         profile_picture = request.files.get('profile_picture')
         if profile_picture and allowed_file(profile_picture.filename):
             filename = secure_filename(profile_picture.filename)
             profile_picture.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            current_user.profile_picture = filename
+            fields['profile_picture'] = filename
+        store.update_user(current_user._get_current_object(), **fields)
         flash('Profile updated successfully.', 'success')
         return redirect(url_for('profile'))
     return render_template('edit_profile.html', user=current_user)
@@ -211,12 +375,14 @@ def search():
     query = ''
     results = []
     user_results = []
-    sort = 'date'
+    sort = 'relevance'
     start_date = ''
     end_date = ''
     file_type = ''
     department = ''
     user = ''
+    facets = {}
+    facet_counts = {}
 
     if request.method == 'POST':
         query = request.form['query'].lower()  # Convert to lowercase for case-insensitive search
@@ -226,66 +392,130 @@ def search():
         file_type = request.form['file_type']
         department = request.form['department'].lower()
         user = request.form['user'].lower()
+        facets = {field: request.form.getlist(field) for field in FACET_FIELDS if request.form.getlist(field)}
 
-        results = [post for post in posts if query in post['title'].lower() or query in post['description'].lower() or query in ' '.join(post['keywords']).lower() or any(query in comment['text'].lower() and comment['post_id'] == post['id'] for comment in comments) or (post['filename'] and query == file_info(post['filename'])[1].lower())]
-        if start_date:
-            results = [post for post in results if post.get('date') and post['date'] >= start_date]
-        if end_date:
-            results = [post for post in results if post.get('date') and post['date'] <= end_date]
-        if file_type:
-            results = [post for post in results if post.get('filename') and post['filename'].endswith(file_type)]
+        authors = None
         if department:
-            results = [post for post in results if post.get('user') and users[find_user_id(post['user'])].department.lower() == department]
-        if user:
-            results = [post for post in results if post.get('user') and user in post['user'].lower()]
+            authors = store.authors_in_department(department)
+        with span('search'):
+            results, facet_counts = search_index.faceted_search(query, start_date=start_date, end_date=end_date, file_type=file_type,
+                                                                authors=authors, author_text=user, sort=sort, facets=facets)
+        results = [dict(post, user_id=store.user_id_for_name(post['user']), likes=store.like_count(post['id'])) for post in results]
+        user_results = [user for user in store.users.values() if query in user.name.lower() or query in user.department.lower()]
 
-        user_results = [user for user in users.values() if query in user.name.lower() or query in user.department.lower()]
-
-        if sort == 'popularity':
-            results.sort(key=lambda x: x['likes'], reverse=True)
-        elif sort == 'comments':
-            results.sort(key=lambda x: len([comment for comment in comments if comment['post_id'] == x['id']]), reverse=True)
-        else:
-            results.sort(key=lambda x: x.get('date', ''), reverse=True)
-
-    return render_template('search.html', query=query, results=results, user_results=user_results, sort=sort, start_date=start_date, end_date=end_date, file_type=file_type, department=department, user=user, file_info=file_info)
+    return render_template('search.html', query=query, results=results, user_results=user_results, sort=sort, start_date=start_date, end_date=end_date, file_type=file_type, department=department, user=user, file_info=file_info,
+                           facets=facets, facet_counts=facet_counts, facet_labels=FACET_FIELDS)
 
 @app.route('/download/<filename>')
 @login_required
 def download_file(filename):
-    downloads[filename] = downloads.get(filename, 0) + 1
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    attachment = store.attachments.get(filename)
+    # A strong ETag from the content hash lets browsers and caches revalidate and resume with Range requests
+    etag = attachment['sha256'] if attachment else True
+    if app.config['X_ACCEL_REDIRECT_PREFIX'] and attachment:
+        if request.if_none_match.contains(etag):
+            return '', 304
+        # Counted like the send_from_directory responses below: a Range request resumes a download,
+        # unless its If-Range names another version and nginx sends the whole file
+        if request.range is None or request.if_range.etag not in (None, etag):
+            store.record_download(filename)
+        response = app.response_class(mimetype=attachment['mime_type'])
+        response.headers['X-Accel-Redirect'] = app.config['X_ACCEL_REDIRECT_PREFIX'] + secure_filename(filename)
+        response.headers['Content-Disposition'] = f'attachment; filename="{secure_filename(filename)}"'
+        response.set_etag(etag)
+        return response
+    with span('fs.send_file'):
+        response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, conditional=True, etag=etag)
+    # Only count the request that starts a download, not revalidations or resumed ranges
+    if response.status_code == 200:
+        store.record_download(filename)
+    return response
 
 @app.route('/post/<int:post_id>', methods=['GET', 'POST'])
 @login_required
 def view_post(post_id):
-    post = next((post for post in posts if post['id'] == post_id), None)
+    post = store.get_post(post_id)
     if post:
         if request.method == 'POST':
             if 'comment' in request.form:
                 comment_text = request.form['comment']
-                comment = {'post_id': post_id, 'user': current_user.name, 'text': comment_text, 'id': len(comments) + 1}
-                comments.append(comment)
+                comment = store.add_comment(post_id, current_user.name, comment_text)
+                search_index.add_comment(comment)
             elif 'like_comment' in request.form:
                 comment_id = int(request.form['comment_id'])
-                if not any(like['comment_id'] == comment_id and like['user'] == current_user.name for like in comment_likes):
-                    comment_likes.append({'comment_id': comment_id, 'user': current_user.name})
-        post_comments = [comment for comment in comments if comment['post_id'] == post_id]
-        post_likes = [like for like in likes if like['post_id'] == post_id]
-        closest_posts_plot_html = get_closest_posts_plot_html(post['title'])
-        return render_template('single_post.html', post=post, comments=post_comments, likes=post_likes, comment_likes=comment_likes, file_info=file_info, closest_posts_plot_html=closest_posts_plot_html)
+                store.like_comment(comment_id, current_user.name)
+        return render_template('single_post.html', post=post, comments=store.comments_for(post_id), store=store, file_info=file_info, can_preview=can_preview)
     else:
         flash('Post not found.', 'error')
         return redirect(url_for('posts_view'))
 
+@app.route('/post/<int:post_id>/graph')
+@login_required
+def post_graph(post_id):
+    post = store.get_post(post_id)
+    if not post:
+        return jsonify({'error': 'Post not found.'}), 404
+    try:
+        return jsonify(closest_posts_cache.get_or_set(post_id, lambda: similarity.closest_posts_graph(post_id)))
+    except SimilarityUnavailable as e:
+        return jsonify({'error': str(e)}), 503
+
+@app.route('/post/<int:post_id>/preview')
+@login_required
+def post_preview(post_id):
+    post = store.get_post(post_id)
+    attachment = store.attachments.get(post['filename']) if post and post['filename'] else None
+    if not attachment:
+        return jsonify({'error': 'This post has no attached file.'}), 404
+    try:
+        with span('fs.preview'):
+            preview = get_preview(app.config['UPLOAD_FOLDER'], attachment)
+        return jsonify(preview)
+    except PreviewError as e:
+        return jsonify({'error': str(e)}), 422
+
+@app.errorhandler(DatasetError)
+def dataset_error(error):
+    return jsonify({'error': error.message}), error.status
+
+def ingested_attachment(filename):
+    attachment = store.attachments.get(filename)
+    if not attachment:
+        raise DatasetError('File not found.', 404)
+    if not is_ingested(app.config['UPLOAD_FOLDER'], attachment):
+        if ingest_in_background(filename) is None:
+            raise DatasetError('This file is not a long-format table.', 404)
+        raise DatasetError('This file is still being ingested, try again shortly.', 202)
+    return attachment
+
+@app.route('/api/datasets/<filename>/rows')
+@login_required
+def dataset_rows(filename):
+    # Filter with ?<column>=<value>[,<value>...], pick columns with ?columns=a,b and cap rows with ?limit=
+    attachment = ingested_attachment(filename)
+    with span('fs.dataset_rows'):
+        return jsonify(query_rows(app.config['UPLOAD_FOLDER'], attachment, request.args))
+
+@app.route('/api/datasets/<filename>/aggregates')
+@login_required
+def dataset_aggregates(filename):
+    # Filter like the rows, and roll up to fewer dimensions with ?by=geno,Drug,hour
+    attachment = ingested_attachment(filename)
+    with span('fs.dataset_aggregates'):
+        return jsonify(query_aggregates(app.config['UPLOAD_FOLDER'], attachment, request.args))
+
+@app.route('/lib/<path:filename>')
+def lib_file(filename):
+    return send_from_directory('lib', filename)
+
 @app.route('/user/<int:user_id>')
 @login_required
 def view_user_profile(user_id):
-    user = users.get(str(user_id))
+    user = store.users.get(str(user_id))
     if user:
-        user_posts = [post for post in posts if post['user'] == user.name]
-        liked_posts = [post for post in posts if any(like['post_id'] == post['id'] and like['user'] == user.name for like in likes)]
-        return render_template('view_profile.html', user=user, posts=user_posts, liked_posts=liked_posts, users=users)
+        user_posts = store.posts_by(user.name)
+        liked_posts = store.liked_posts(user.name)
+        return render_template('view_profile.html', user=user, posts=user_posts, liked_posts=liked_posts, users=store.users)
     else:
         flash('User not found.', 'error')
         return redirect(url_for('index'))
@@ -293,11 +523,9 @@ def view_user_profile(user_id):
 @app.route('/follow/<int:user_id>')
 @login_required
 def follow_user(user_id):
-    user_to_follow = users.get(str(user_id))
+    user_to_follow = store.users.get(str(user_id))
     if user_to_follow and current_user.id != str(user_id):
-        if str(user_id) not in current_user.following:
-            current_user.following.append(str(user_id))
-            user_to_follow.followers.append(current_user.id)
+        store.follow(current_user.id, str(user_id))
         flash(f'You are now following {user_to_follow.name}', 'success')
     else:
         flash('User not found or you cannot follow yourself', 'error')
@@ -306,11 +534,9 @@ def follow_user(user_id):
 @app.route('/unfollow/<int:user_id>')
 @login_required
 def unfollow_user(user_id):
-    user_to_unfollow = users.get(str(user_id))
+    user_to_unfollow = store.users.get(str(user_id))
     if user_to_unfollow and current_user.id != str(user_id):
-        if str(user_id) in current_user.following:
-            current_user.following.remove(str(user_id))
-            user_to_unfollow.followers.remove(current_user.id)
+        store.unfollow(current_user.id, str(user_id))
         flash(f'You have unfollowed {user_to_unfollow.name}', 'success')
     else:
         flash('User not found or you cannot unfollow yourself', 'error')
@@ -318,12 +544,7 @@ def unfollow_user(user_id):
 
 @app.context_processor
 def utility_processor():
-    def find_user_id(username):
-        for user_id, user in users.items():
-            if user.name == username:
-                return user_id
-        return None
-    return dict(find_user_id=find_user_id)
+    return dict(find_user_id=store.user_id_for_name)
 
 def make_files():
     if not os.path.exists('uploads'):
@@ -337,42 +558,29 @@ def make_files():
         with open('posts.tsv', 'w') as f:
             f.write('Title\tDescription\tKeywords\tDataset Type\tCollection Period\tOrganism\tGenes\tTissue/Cell Type\tCondition\tTechnique\tInstrument Platform\tSoftware\tUsage Restrictions\tRelated Datasets\tLink\tFilename\tUser\tPost ID\tLikes\n')
 
-    with open('users.tsv', 'r') as f:
-        for i, line in enumerate(f):
-            if i == 0:
-                continue
-            name, job_title, email, department, profile_picture, bio, research_interests, website = line.split('\t')
-            user = User(str(i), name, job_title, email, department, profile_picture, bio, research_interests, website)
-            users[str(i)] = user
-
-    with open('posts.tsv', 'r') as f:
-        for i, line in enumerate(f):
-            if i == 0:
-                continue
-            title, description, keywords, dataset_type, collection_period, organism, genes, tissue_celltype, condition, technique, instrument_platform, software, usage_restrictions, related_datasets, link, filename, user, post_id, post_likes = line.split('\t')
-            post = {
-                'title': title,
-                'description': description,
-                'keywords': keywords.split(),
-                'dataset_type': dataset_type,
-                'collection_period': collection_period,
-                'organism': organism,
-                'genes': genes,
-                'tissue_celltype': tissue_celltype,
-                'condition': condition,
-                'technique': technique,
-                'instrument_platform': instrument_platform,
-                'software': software,
-                'usage_restrictions': usage_restrictions,
-                'related_datasets': related_datasets,
-                'link': link,
-                'filename': filename,
-                'user': user,
-                'id': int(post_id),
-                'likes': int(post_likes)
-            }
-            posts.append(post)
+    # The TSV files are only read to seed an empty database, after that SQLite is the source of truth
+    store.backend.init_schema()
+    if store.backend.is_empty():
+        import_tsv(store.backend, 'posts.tsv', 'users.tsv')
+    store.load(User)
+    for post in store.all_posts():
+        search_index.add_post(post)
+    for comment in store.comments.values():
+        search_index.add_comment(comment)
+    reconciler.reconcile()
+
+def start_background_tasks():
+    """
+    Start the threads of one serving process. Threads do not survive a fork, so under gunicorn
+    this runs in every worker after it is forked, see gunicorn.conf.py.
+    """
+    reconciler.start()
+    upload_sessions.start()
+    change_log_pruner.start()
+    store.start_counters()
+    similarity.start()
 
 if __name__ == '__main__':
     make_files()
+    start_background_tasks()
     app.run(host='0.0.0.0', debug=True, port=5001)
@@ -0,0 +1,101 @@
+import fcntl
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1 << 20
+# Held by the one process that reconciles the upload folder, see AttachmentReconciler
+RECONCILER_LOCK = '.reconciler.lock'
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def attachment_metadata(folder, filename, sha256=None):
+    """
+    Size, extension, content hash and MIME type of an uploaded file. Pass sha256 if the
+    caller already hashed the file while writing it.
+    """
+    path = os.path.join(folder, filename)
+    stat = os.stat(path)
+    return {
+        'filename': filename,
+        'size': stat.st_size,
+        'extension': filename.rsplit('.', 1)[1].lower() if '.' in filename else '',
+        'sha256': sha256 or file_sha256(path),
+        'mime_type': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        'mtime': stat.st_mtime,
+    }
+
+
+class AttachmentReconciler:
+    """
+    Keeps the store's attachment metadata in line with the files in the upload folder, so
+    files copied in out of band get recorded too. Only new files and files whose size or
+    mtime changed are re-hashed.
+
+    Under several worker processes only one reconciles: the first to take a file lock in the
+    upload folder keeps it while it lives, and the others record nothing themselves but get
+    its changes through Store.sync(). If it exits, another one takes over.
+    """
+
+    def __init__(self, store, folder, interval=300):
+        self.store = store
+        self.folder = folder
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def reconcile(self):
+        # Only files known before the scan can be forgotten: one uploaded while it runs is
+        # recorded without being in seen
+        known_before = list(self.store.attachments)
+        seen = set()
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith('.'):
+                    continue
+                seen.add(entry.name)
+                known = self.store.attachments.get(entry.name)
+                stat = entry.stat()
+                if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+                    continue
+                try:
+                    self.store.record_attachment(attachment_metadata(self.folder, entry.name))
+                except OSError:
+                    logger.exception("Could not read attachment %s", entry.name)
+        for filename in known_before:
+            if filename not in seen:
+                self.store.forget_attachment(filename)
+
+    def _run(self):
+        with open(os.path.join(self.folder, RECONCILER_LOCK), 'a') as lock:
+            leading = False
+            while not self._stop.wait(self.interval):
+                if not leading:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    leading = True
+                try:
+                    self.reconcile()
+                except Exception:
+                    logger.exception("Attachment reconciliation failed")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='attachment-reconciler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
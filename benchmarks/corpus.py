@@ -0,0 +1,134 @@
+"""
+Synthetic Broad Atlas database for benchmarks: users, posts, comments, likes and follows at
+any scale, drawn from the vocabulary and field values of the real posts.tsv so search,
+facets and the templates see realistic text. Authorship, likes and follows are skewed, a
+few users post and are followed far more than the rest, as on the real site.
+
+    python benchmarks/corpus.py --posts 100000 --db /tmp/bench.db
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from storage import (INSERT_COMMENT, INSERT_FOLLOW, INSERT_LIKE, INSERT_POST, INSERT_USER, POST_FIELDS,  # noqa: E402
+                     SQLiteStorage, read_posts_tsv, read_users_tsv)
+
+# Rows written per transaction
+CHUNK_ROWS = 50_000
+DEPARTMENTS = ['Department of Test', 'Cancer Program', 'Stanley Center', 'Metabolism Program', 'Data Sciences Platform',
+               'Genomics Platform', 'Cell Circuits Program', 'Infectious Disease and Microbiome Program']
+CATEGORICAL_FIELDS = ['dataset_type', 'collection_period', 'organism', 'tissue_celltype', 'condition', 'technique',
+                      'instrument_platform', 'software', 'usage_restrictions']
+
+
+def scale(posts):
+    """
+    Row counts for a corpus of the given number of posts, in roughly the site's proportions.
+    """
+    users = max(10, posts // 10)
+    return {'users': users, 'posts': posts, 'comments': 2 * posts, 'likes': 5 * posts, 'follows': 20 * users}
+
+
+def _skewed(rng, n):
+    # Pareto-distributed index: about half the picks fall in the first 1% of 0..n-1, like an 80/20 rule
+    return min(int((rng.paretovariate(1.16) - 1) * max(1, n // 100)), n - 1)
+
+
+def _chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_ROWS:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Vocabulary:
+    def __init__(self, posts, users):
+        self.words = sorted({word for post in posts for field in ('title', 'description') for word in post[field].split()})
+        self.keywords = sorted({keyword for post in posts for keyword in post['keywords']})
+        self.values = {field: [post[field] for post in posts if post[field]] or [''] for field in CATEGORICAL_FIELDS}
+        self.names = sorted({user['name'] for user in users})
+
+    def text(self, rng, n_words):
+        return ' '.join(rng.choice(self.words) for _ in range(n_words))
+
+
+def user_rows(rng, vocabulary, n):
+    for i in range(1, n + 1):
+        yield [str(i), f'{rng.choice(vocabulary.names)} {i}', 'Scientist', f'user{i}@broadinstitute.org',
+               rng.choice(DEPARTMENTS), None, vocabulary.text(rng, 12), vocabulary.text(rng, 4), '']
+
+
+def post_rows(rng, vocabulary, n, user_names):
+    for i in range(1, n + 1):
+        post = {field: rng.choice(vocabulary.values[field]) if rng.random() < 0.7 else '' for field in CATEGORICAL_FIELDS}
+        post.update({
+            'id': i,
+            'title': vocabulary.text(rng, rng.randint(3, 8)).title(),
+            'description': vocabulary.text(rng, rng.randint(10, 60)),
+            'keywords': ' '.join(rng.sample(vocabulary.keywords, min(rng.randint(3, 6), len(vocabulary.keywords)))),
+            'genes': '',
+            'related_datasets': '',
+            'link': '',
+            'filename': None,
+            'user': user_names[_skewed(rng, len(user_names))],
+            'likes': 0,
+        })
+        yield [post[field] for field in POST_FIELDS]
+
+
+def generate(path, posts, seed=0, posts_tsv=os.path.join(REPO, 'posts.tsv'), users_tsv=os.path.join(REPO, 'users.tsv')):
+    """
+    Write a corpus of the given number of posts to a new SQLite database at path and return
+    the row counts.
+    """
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    counts = scale(posts)
+    rng = random.Random(seed)
+    vocabulary = Vocabulary(read_posts_tsv(posts_tsv), read_users_tsv(users_tsv))
+    storage = SQLiteStorage(path)
+    storage.init_schema()
+
+    user_names = []
+    for chunk in _chunks(user_rows(rng, vocabulary, counts['users'])):
+        storage._write_many(INSERT_USER, chunk)
+        user_names.extend(row[1] for row in chunk)
+    for chunk in _chunks(post_rows(rng, vocabulary, counts['posts'], user_names)):
+        storage._write_many(INSERT_POST, chunk)
+    # Newer posts get more of the comments and likes
+    recent = lambda: counts['posts'] - _skewed(rng, counts['posts'])  # noqa: E731
+    comments = ([recent(), rng.choice(user_names), vocabulary.text(rng, rng.randint(3, 30))] for _ in range(counts['comments']))
+    for chunk in _chunks(comments):
+        storage._write_many(INSERT_COMMENT, chunk)
+    likes = ([recent(), rng.choice(user_names)] for _ in range(counts['likes']))
+    for chunk in _chunks(likes):
+        storage._write_many(INSERT_LIKE, chunk)
+    follows = ([str(rng.randint(1, counts['users'])), str(_skewed(rng, counts['users']) + 1)] for _ in range(counts['follows']))
+    for chunk in _chunks(follows):
+        storage._write_many(INSERT_FOLLOW, chunk)
+    with storage.batch() as conn:
+        conn.execute('DELETE FROM follows WHERE follower_id = followee_id')
+        conn.execute('UPDATE posts SET likes = (SELECT COUNT(*) FROM likes WHERE likes.post_id = posts.id)')
+    storage.close()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic Broad Atlas database.')
+    parser.add_argument('--posts', type=int, default=10_000)
+    parser.add_argument('--db', required=True, help='SQLite database to create')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    counts = generate(args.db, args.posts, args.seed)
+    print(f"Wrote {', '.join(f'{n} {table}' for table, n in counts.items())} to {args.db} "
+          f"in {time.perf_counter() - start:.1f} s")
@@ -0,0 +1,298 @@
+"""
+Route benchmark on a synthetic corpus (see corpus.py): p50 and p99 latency, throughput and
+peak RSS for the main pages, at any scale from a thousand to a million posts.
+
+    python benchmarks/routes.py --posts 10000                      # Flask test client
+    python benchmarks/routes.py --posts 100000 --mode server --workers 4 --concurrency 16
+
+In client mode one fresh process loads the corpus and requests each route in turn through
+Flask's test client, which measures the app alone. In server mode the app runs under
+gunicorn with gunicorn.conf.py (or werkzeug's forking server with --server werkzeug, where
+gunicorn is not installed) and concurrent clients drive it over HTTP, so the numbers include
+the workers competing for CPU and SQLite.
+
+Every run is appended to benchmarks/results.jsonl, which is kept out of git, with the commit
+it ran on, and compared with the latest run of another commit with the same settings, so
+regressions show up as the change in p50 and p99.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timezone
+
+from corpus import REPO, generate
+
+RESULTS_PATH = os.path.join(REPO, 'benchmarks', 'results.jsonl')
+SEARCH_FORM = {'query': 'human genome', 'sort': 'relevance', 'start_date': '', 'end_date': '', 'file_type': '',
+               'department': '', 'user': ''}
+# Name, method, path ({post_id} and {user_id} are filled in at random) and form data
+ROUTES = [
+    ('home', 'GET', '/', None),
+    ('posts', 'GET', '/posts', None),
+    ('posts_api', 'GET', '/api/posts', None),
+    ('post', 'GET', '/post/{post_id}', None),
+    ('profile', 'GET', '/profile', None),
+    ('user', 'GET', '/user/{user_id}', None),
+    ('search', 'POST', '/search', SEARCH_FORM),
+]
+SERVER_START_TIMEOUT = 600
+
+CLIENT_RUN = r"""
+import json, random, resource, sys, time
+sys.path.insert(0, sys.argv[1])
+import app
+start = time.perf_counter()
+app.make_files()
+load_seconds = time.perf_counter() - start
+routes, requests, n_posts, n_users = json.loads(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5])
+rng = random.Random(0)
+client = app.app.test_client()
+client.post('/login', data={'email': 'user1@broadinstitute.org'})
+results = {}
+for name, method, path, form in routes:
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(requests):
+        url = path.format(post_id=rng.randint(1, n_posts), user_id=rng.randint(1, n_users))
+        t = time.perf_counter()
+        response = client.open(url, method=method, data=form)
+        latencies.append(time.perf_counter() - t)
+        assert response.status_code == 200, (url, response.status_code)
+    # ru_maxrss is in KB on Linux
+    results[name] = {'latencies': latencies, 'seconds': time.perf_counter() - start,
+                     'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+print(json.dumps({'load_seconds': load_seconds, 'routes': results}))
+"""
+
+SERVER_APP = """
+from app import app, make_files
+
+# wsgi.py without the embedding preload, the synthetic corpus has no embeddings
+make_files()
+"""
+
+
+def current_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD'], cwd=REPO).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def summarize(latencies, seconds, peak_rss_kb):
+    cuts = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p99_ms': round(cuts[98] * 1000, 2),
+        'throughput_rps': round(len(latencies) / seconds, 1),
+        'peak_rss_mb': round(peak_rss_kb / 1024, 1) if peak_rss_kb is not None else None,
+    }
+
+
+def run_client(workdir, counts, requests):
+    out = subprocess.run([sys.executable, '-c', CLIENT_RUN, REPO, json.dumps(ROUTES), str(requests),
+                          str(counts['posts']), str(counts['users'])],
+                         cwd=workdir, capture_output=True, text=True)
+    if out.returncode != 0:
+        raise RuntimeError(out.stderr[-2000:])
+    run = json.loads(out.stdout.strip().splitlines()[-1])
+    routes = {name: summarize(r['latencies'], r['seconds'], r['peak_rss_kb']) for name, r in run['routes'].items()}
+    return run['load_seconds'], routes
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _peak_rss_kb(pid):
+    # Children that exit while they are being read, e.g. werkzeug's per-request forks, count as 0
+    total = 0
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            total += next((int(line.split()[1]) for line in f if line.startswith('VmHWM:')), 0)
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                total += sum(_peak_rss_kb(int(child)) for child in f.read().split())
+    except FileNotFoundError:
+        pass
+    return total
+
+
+def tree_peak_rss_kb(pid):
+    """
+    Sum of the peak RSS of a process and its live children, e.g. a gunicorn master and
+    workers, from /proc, or None where there is no /proc.
+    """
+    if not os.path.exists(f'/proc/{pid}/status'):
+        return None
+    return _peak_rss_kb(pid)
+
+
+def start_server(workdir, server, port, workers, threads):
+    with open(os.path.join(workdir, 'bench_app.py'), 'w') as f:
+        f.write(SERVER_APP)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([workdir, REPO, os.environ.get('PYTHONPATH', '')]))
+    if server == 'gunicorn':
+        env.update(BIND=f'127.0.0.1:{port}', WEB_CONCURRENCY=str(workers), THREADS=str(threads))
+        command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO, 'gunicorn.conf.py'), 'bench_app:app']
+    else:
+        command = [sys.executable, '-c', 'import bench_app; from werkzeug.serving import run_simple; '
+                   f'run_simple("127.0.0.1", {port}, bench_app.app, processes={workers})']
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{server} exited with status {process.returncode}')
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=5)
+            return process
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.5)
+    process.kill()
+    raise RuntimeError(f'{server} did not start within {SERVER_START_TIMEOUT} s')
+
+
+class Client:
+    """
+    One simulated user: a cookie session logged in as user{n}.
+    """
+
+    def __init__(self, base_url, n):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.request('POST', '/login', {'email': f'user{n}@broadinstitute.org'})
+
+    def request(self, method, path, form=None):
+        data = urllib.parse.urlencode(form).encode() if form is not None else None
+        with self.opener.open(urllib.request.Request(self.base_url + path, data=data, method=method), timeout=60) as response:
+            response.read()
+            return response.status
+
+
+def run_server(workdir, counts, requests, server, workers, threads, concurrency):
+    port = _free_port()
+    start = time.perf_counter()
+    process = start_server(workdir, server, port, workers, threads)
+    load_seconds = time.perf_counter() - start
+    try:
+        base_url = f'http://127.0.0.1:{port}'
+        clients = [Client(base_url, n + 1) for n in range(min(concurrency, counts['users']))]
+        routes = {}
+        for name, method, path, form in ROUTES:
+            latencies = []
+            lock = threading.Lock()
+
+            def drive(client, n_requests, seed):
+                rng = random.Random(seed)
+                mine = []
+                for _ in range(n_requests):
+                    url = path.format(post_id=rng.randint(1, counts['posts']), user_id=rng.randint(1, counts['users']))
+                    t = time.perf_counter()
+                    status = client.request(method, url, form)
+                    mine.append(time.perf_counter() - t)
+                    assert status == 200, (url, status)
+                with lock:
+                    latencies.extend(mine)
+
+            shares = [requests // len(clients) + (i < requests % len(clients)) for i in range(len(clients))]
+            drivers = [threading.Thread(target=drive, args=(client, share, i)) for i, (client, share) in enumerate(zip(clients, shares))]
+            t = time.perf_counter()
+            for thread in drivers:
+                thread.start()
+            for thread in drivers:
+                thread.join()
+            routes[name] = summarize(latencies, time.perf_counter() - t, tree_peak_rss_kb(process.pid))
+        return load_seconds, routes
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def previous_result(results_path, settings, commit):
+    if not os.path.exists(results_path):
+        return None
+    previous = None
+    with open(results_path) as f:
+        for line in f:
+            result = json.loads(line)
+            if result['settings'] == settings and result['commit'] != commit:
+                previous = result
+    return previous
+
+
+def change(new, old):
+    if not old:
+        return ''
+    return f' ({(new - old) / old:+.0%})'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the main routes on a synthetic corpus.')
+    parser.add_argument('--posts', type=int, default=10_000, help='corpus size, users and the rest scale with it')
+    parser.add_argument('--mode', choices=['client', 'server'], default='client')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--server', choices=['gunicorn', 'werkzeug'], default='gunicorn')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4, help='threads per gunicorn worker')
+    parser.add_argument('--concurrency', type=int, default=16, help='simultaneous clients in server mode')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--results', default=RESULTS_PATH, help='JSON lines file the results are appended to')
+    parser.add_argument('--no-save', action='store_true', help='print the results without saving them')
+    args = parser.parse_args()
+
+    settings = {'mode': args.mode, 'posts': args.posts, 'requests': args.requests, 'seed': args.seed}
+    if args.mode == 'server':
+        settings.update(server=args.server, workers=args.workers, threads=args.threads, concurrency=args.concurrency)
+    workdir = tempfile.mkdtemp(prefix='routes-')
+    # The app trains and serves the closest-posts embeddings from the posts.tsv in its working directory
+    shutil.copy(os.path.join(REPO, 'posts.tsv'), workdir)
+    try:
+        start = time.perf_counter()
+        counts = generate(os.path.join(workdir, 'broad_atlas.db'), args.posts, args.seed)
+        print(f"Generated {', '.join(f'{n} {table}' for table, n in counts.items())} in {time.perf_counter() - start:.1f} s")
+        if args.mode == 'client':
+            load_seconds, routes = run_client(workdir, counts, args.requests)
+        else:
+            load_seconds, routes = run_server(workdir, counts, args.requests, args.server, args.workers, args.threads,
+                                              args.concurrency)
+    finally:
+        shutil.rmtree(workdir)
+
+    commit = current_commit()
+    previous = previous_result(args.results, settings, commit)
+    print(f"Loaded in {load_seconds:.1f} s" + (f", compared with {previous['commit']}" if previous else ''))
+    print(f"{'route':10} {'p50 ms':>16} {'p99 ms':>16} {'req/s':>8} {'peak RSS MB':>12}")
+    for name, stats in routes.items():
+        old = previous['routes'].get(name) if previous else None
+        p50 = f"{stats['p50_ms']:.1f}{change(stats['p50_ms'], old and old['p50_ms'])}"
+        p99 = f"{stats['p99_ms']:.1f}{change(stats['p99_ms'], old and old['p99_ms'])}"
+        print(f"{name:10} {p50:>16} {p99:>16} {stats['throughput_rps']:>8.1f} {stats['peak_rss_mb'] or '-':>12}")
+    if not args.no_save:
+        with open(args.results, 'a') as f:
+            f.write(json.dumps({
+                'commit': commit,
+                'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'settings': settings,
+                'counts': counts,
+                'load_seconds': round(load_seconds, 2),
+                'routes': routes,
+            }) + '\n')
@@ -0,0 +1,86 @@
+"""
+Startup-time benchmark: how long a fresh process takes to import the app, load the store, and
+answer its first /, /login and /posts requests. It exits with status 1 if the median is over
+its budget, or if startup imported one of the heavy libraries the closest-posts feature loads
+lazily. That makes it usable as a regression check:
+
+    python benchmarks/startup.py [--runs 5] [--budget 2.0]
+
+Each run is a new interpreter in a scratch copy of posts.tsv and users.tsv, so the database
+import from the TSV files is part of the measurement, as on a first deploy.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Must not be imported before the first request is served, see similarity.SimilarityService
+LAZY_MODULES = ['gensim', 'sklearn', 'networkx', 'pyvis', 'spacy', 'torch', 'keybert', 'find_closest_posts']
+
+RUN = r"""
+import importlib.machinery, json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app
+import similarity
+imported = time.perf_counter()
+app.make_files()
+loaded = time.perf_counter()
+client = app.app.test_client()
+timings = {'import': imported - start, 'load': loaded - imported}
+for url in ['/', '/login']:
+    t = time.perf_counter()
+    assert client.get(url).status_code == 200, url
+    timings[url] = time.perf_counter() - t
+client.post('/login', data={'email': 'test@broadinstitute.org'})
+t = time.perf_counter()
+assert client.get('/posts').status_code == 200, '/posts'
+timings['/posts'] = time.perf_counter() - t
+timings['total'] = time.perf_counter() - start
+timings['heavy_modules'] = sorted(name for name in json.loads(sys.argv[2]) if name in sys.modules)
+# The lazy-import check only means something if the app can find the module once asked to
+timings['similarity_found'] = importlib.machinery.PathFinder.find_spec(
+    'find_closest_posts', [similarity.MODULE_DIR]) is not None
+print(json.dumps(timings))
+"""
+
+
+def run_once():
+    workdir = tempfile.mkdtemp(prefix='startup-')
+    try:
+        for name in ['posts.tsv', 'users.tsv']:
+            shutil.copy(os.path.join(REPO, name), workdir)
+        out = subprocess.run([sys.executable, '-c', RUN, REPO, json.dumps(LAZY_MODULES)], cwd=workdir,
+                             capture_output=True, text=True, check=True).stdout
+        return json.loads(out.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure app startup time.')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=2.0, help='maximum median seconds to the first /posts response')
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    for key in ['import', 'load', '/', '/login', '/posts', 'total']:
+        print(f"{key:8} median {statistics.median(run[key] for run in runs) * 1000:8.1f} ms")
+    heavy = sorted(set().union(*(run['heavy_modules'] for run in runs)))
+    median_total = statistics.median(run['total'] for run in runs)
+    failed = False
+    if heavy:
+        print(f"FAIL: startup imported {', '.join(heavy)}")
+        failed = True
+    if not all(run['similarity_found'] for run in runs):
+        print("FAIL: find_closest_posts cannot be found, so it was not imported for the wrong reason")
+        failed = True
+    if median_total > args.budget:
+        print(f"FAIL: median startup {median_total:.2f} s is over the {args.budget:.2f} s budget")
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,275 @@
+import hashlib
+import json
+import logging
+import os
+import secrets
+import tempfile
+import threading
+import time
+
+from werkzeug.utils import secure_filename
+
+from attachments import HASH_CHUNK_SIZE, attachment_metadata, file_sha256
+
+SESSION_DIR = '.sessions'
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def stored_filename(sha256, filename):
+    """
+    Content-addressed name for an upload: two different files with the same name no longer
+    overwrite each other, and the original name is kept for downloads. The name and the
+    extension are cleaned separately, secure_filename drops characters it cannot transliterate
+    and would otherwise take the dot with them.
+    """
+    name, _, extension = filename.rpartition('.')
+    if not name:
+        name, extension = filename, ''
+    name = secure_filename(name) or 'file'
+    extension = secure_filename(extension)
+    return f"{sha256[:16]}_{name}.{extension}" if extension else f"{sha256[:16]}_{name}"
+
+
+def _copy_stream(stream, out, hasher=None, limit=None):
+    """
+    Copy stream to out in HASH_CHUNK_SIZE pieces so memory stays bounded whatever the size,
+    returning the number of bytes written.
+    """
+    written = 0
+    while True:
+        chunk = stream.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            return written
+        written += len(chunk)
+        if limit is not None and written > limit:
+            raise UploadError('Upload is larger than announced.', 413)
+        out.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+
+
+class UploadSessions:
+    """
+    Resumable, chunked uploads streamed straight into the upload folder.
+
+    A session is created with the file name and total size. Chunks are then PUT at
+    increasing byte offsets, and a client that lost its connection asks for the current
+    offset and carries on from there. Session state lives in small JSON files next to the
+    partial upload, so sessions survive a restart. On completion the file is stored under
+    its content hash. A file that was already uploaded is deduplicated to the existing copy.
+    The completed session is kept until the post the file belongs to claims it.
+    Sessions that received nothing for max_age seconds are abandoned and deleted.
+    """
+
+    def __init__(self, store, folder, max_size, max_age=24 * 3600, interval=3600):
+        self.store = store
+        self.folder = folder
+        self.session_dir = os.path.join(folder, SESSION_DIR)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        # Running hash of each session and the number of bytes it covers, so completing an
+        # upload whose chunks all reached this process does not need to read the file back.
+        # Under several workers a chunk can land elsewhere, the offset then no longer matches
+        # and the hash is dropped
+        self._hashers = {}
+
+    def _lock(self, session_id):
+        with self._locks_lock:
+            return self._locks.setdefault(session_id, threading.Lock())
+
+    def _paths(self, session_id):
+        if not session_id.replace('-', '').replace('_', '').isalnum():
+            raise UploadError('Upload session not found.', 404)
+        base = os.path.join(self.session_dir, session_id)
+        return base + '.json', base + '.part'
+
+    def _read(self, session_id, user_id):
+        meta_path, _ = self._paths(session_id)
+        try:
+            with open(meta_path) as f:
+                session = json.load(f)
+        except FileNotFoundError:
+            raise UploadError('Upload session not found.', 404)
+        if session['user_id'] != user_id:
+            raise UploadError('Upload session not found.', 404)
+        return session
+
+    def _write(self, session):
+        meta_path, _ = self._paths(session['id'])
+        tmp_path = meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(session, f)
+        os.replace(tmp_path, meta_path)
+
+    def create(self, filename, size, user_id):
+        if not filename:
+            raise UploadError('A file name is required.')
+        if size < 0 or size > self.max_size:
+            raise UploadError('File is too large.', 413)
+        os.makedirs(self.session_dir, exist_ok=True)
+        session = {
+            'id': secrets.token_urlsafe(16),
+            'filename': filename,
+            'size': size,
+            'offset': 0,
+            'user_id': user_id,
+        }
+        _, part_path = self._paths(session['id'])
+        open(part_path, 'wb').close()
+        self._write(session)
+        self._hashers[session['id']] = (hashlib.sha256(), 0)
+        return session
+
+    def status(self, session_id, user_id):
+        return self._read(session_id, user_id)
+
+    def write_chunk(self, session_id, user_id, start, stream):
+        with self._lock(session_id):
+            session = self._read(session_id, user_id)
+            if 'stored_filename' in session:
+                raise UploadError('Upload is already complete.', 409)
+            if start != session['offset']:
+                raise UploadError(f"Expected a chunk starting at byte {session['offset']}.", 409)
+            remaining = session['size'] - start
+            _, part_path = self._paths(session_id)
+            # Taken out while the chunk is written: if it fails part of it may have been hashed
+            # but not recorded, and completion rehashes the file
+            hasher, hashed = self._hashers.pop(session_id, (None, None))
+            if hashed != start:
+                hasher = None
+            with open(part_path, 'r+b') as out:
+                out.seek(start)
+                written = _copy_stream(stream, out, hasher, limit=remaining)
+                out.truncate()
+            # A chunk cut short by a dropped connection still counts, the client resumes after it
+            session['offset'] = start + written
+            self._write(session)
+            if hasher is not None:
+                self._hashers[session_id] = (hasher, session['offset'])
+            return session
+
+    def complete(self, session_id, user_id):
+        with self._lock(session_id):
+            session = self._read(session_id, user_id)
+            if session['offset'] != session['size']:
+                raise UploadError(f"Upload is incomplete, {session['offset']} of {session['size']} bytes received.", 409)
+            if 'stored_filename' in session:
+                return session['stored_filename']
+            _, part_path = self._paths(session_id)
+            hasher, hashed = self._hashers.pop(session_id, (None, None))
+            sha256 = hasher.hexdigest() if hashed == session['size'] else file_sha256(part_path)
+            session['stored_filename'] = self._store(part_path, sha256, session['filename'])
+            self._write(session)
+            return session['stored_filename']
+
+    def claim(self, session_id, user_id):
+        """
+        Stored name of a completed upload, for the post it is attached to. The session has to
+        belong to user_id and is deleted, so an upload is attached by its owner at most once.
+        """
+        with self._lock(session_id):
+            session = self._read(session_id, user_id)
+            if 'stored_filename' not in session:
+                raise UploadError('Upload is incomplete.', 409)
+            meta_path, _ = self._paths(session_id)
+            os.remove(meta_path)
+        with self._locks_lock:
+            self._locks.pop(session_id, None)
+        return session['stored_filename']
+
+    def expire(self):
+        """
+        Delete sessions whose state was last written more than max_age seconds ago, along with
+        partial files left behind by a process that died mid-upload. Every process may run
+        this, deleting a file another one already removed is not an error.
+        """
+        cutoff = time.time() - self.max_age
+        expired = 0
+        try:
+            entries = list(os.scandir(self.session_dir))
+        except FileNotFoundError:
+            entries = []
+        sessions = {entry.name[:-len('.json')] for entry in entries if entry.name.endswith('.json')}
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+                if entry.name.endswith('.json'):
+                    session_id = entry.name[:-len('.json')]
+                    with self._lock(session_id):
+                        meta_path, part_path = self._paths(session_id)
+                        if os.stat(meta_path).st_mtime >= cutoff:
+                            continue
+                        os.remove(meta_path)
+                        if os.path.exists(part_path):
+                            os.remove(part_path)
+                    sessions.discard(session_id)
+                    expired += 1
+                elif entry.name.endswith(('.part', '.tmp')) and entry.name.rsplit('.', 1)[0] not in sessions:
+                    os.remove(entry.path)
+            except (FileNotFoundError, UploadError):
+                continue
+        # Sessions completed or expired elsewhere leave their lock and hash behind in this process
+        with self._locks_lock:
+            for session_id in set(self._locks) | set(self._hashers):
+                lock = self._locks.get(session_id)
+                if (lock is None or not lock.locked()) and not os.path.exists(self._paths(session_id)[0]):
+                    self._locks.pop(session_id, None)
+                    self._hashers.pop(session_id, None)
+        if expired:
+            logger.info("Deleted %d abandoned upload sessions", expired)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.expire()
+            except Exception:
+                logger.exception("Could not delete abandoned upload sessions")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='upload-session-expiry', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def save_stream(self, stream, filename):
+        """
+        Store a single-request upload the same way as a completed session: streamed to a
+        temporary file while hashing, then moved to its content-addressed name.
+        """
+        os.makedirs(self.session_dir, exist_ok=True)
+        hasher = hashlib.sha256()
+        fd, part_path = tempfile.mkstemp(dir=self.session_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                _copy_stream(stream, out, hasher, limit=self.max_size)
+            return self._store(part_path, hasher.hexdigest(), filename)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+
+    def _store(self, part_path, sha256, filename):
+        existing = self.store.attachment_by_hash(sha256)
+        if existing is not None and os.path.exists(os.path.join(self.folder, existing['filename'])):
+            os.remove(part_path)
+            return existing['filename']
+        name = stored_filename(sha256, filename)
+        os.replace(part_path, os.path.join(self.folder, name))
+        self.store.record_attachment(attachment_metadata(self.folder, name, sha256=sha256))
+        return name
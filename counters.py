@@ -0,0 +1,128 @@
+import atexit
+import itertools
+import logging
+import threading
+import weakref
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class _ThreadMarker:
+    __slots__ = ('__weakref__',)
+
+
+class BatchedCounter:
+    """
+    Counts increments in memory and hands them to flush(deltas) in one batch every
+    interval seconds, instead of writing to the database on every request. Pending counts
+    are flushed once more at exit, and retried on the next flush if one fails.
+
+    Each thread counts into its own shard, which only it writes to, so increment() takes no
+    lock and threads never lose each other's increments. Shards are never reset: flushing
+    hands over what each shard gained since the previous flush, and count(key) sums the
+    shards, so it is every increment made in this process, flushed or not. Callers merge it
+    on read with the count they loaded from the database. The shard of a thread that ended,
+    e.g. one of the development server's per-request threads, is merged into a shared base
+    shard, so the number of shards stays that of the live threads.
+
+    Without a flush function the counter only counts, e.g. for numbers written to the
+    database some other way.
+    """
+
+    def __init__(self, flush=None, interval=5.0):
+        self._flush = flush
+        self.interval = interval
+        # Counts and flushed counts of the ended threads, and of each live thread by shard id
+        self._base = (Counter(), Counter())
+        self._shards = {}
+        self._retired = []
+        self._ids = itertools.count()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            if self._retired and self._flush_lock.acquire(blocking=False):
+                try:
+                    self._collect()
+                finally:
+                    self._flush_lock.release()
+            shard = self._local.shard = Counter()
+            shard_id = next(self._ids)
+            with self._lock:
+                self._shards[shard_id] = (shard, Counter())
+            # Only the thread-local holds the marker, so it is freed when the thread ends
+            self._local.marker = marker = _ThreadMarker()
+            weakref.finalize(marker, self._retire, shard_id)
+        return shard
+
+    def _retire(self, shard_id):
+        with self._lock:
+            self._retired.append(self._shards.pop(shard_id))
+
+    def _collect(self):
+        # Called holding _flush_lock, so no flush is halfway through the retired shards
+        with self._lock:
+            retired, self._retired = self._retired, []
+            counts, flushed = self._base
+            for shard, shard_flushed in retired:
+                counts.update(shard)
+                flushed.update(shard_flushed)
+
+    def _all(self):
+        with self._lock:
+            return [self._base, *self._shards.values(), *self._retired]
+
+    def increment(self, key, n=1):
+        self._shard()[key] += n
+
+    def count(self, key):
+        return sum(shard.get(key, 0) for shard, _ in self._all())
+
+    def pending(self, key):
+        return sum(shard.get(key, 0) - flushed.get(key, 0) for shard, flushed in self._all())
+
+    def flush(self):
+        if self._flush is None:
+            return
+        with self._flush_lock:
+            self._collect()
+            shards = self._all()
+            deltas = Counter()
+            snapshots = []
+            for shard, flushed in shards:
+                # dict.copy is a single C call, so it cannot see a shard halfway through an update
+                snapshot = dict.copy(shard)
+                for key, n in snapshot.items():
+                    if n != flushed.get(key, 0):
+                        deltas[key] += n - flushed.get(key, 0)
+                snapshots.append((flushed, snapshot))
+            if not deltas:
+                return
+            try:
+                self._flush(dict(deltas))
+            except Exception:
+                logger.exception("Could not flush %d counters, retrying later", len(deltas))
+                return
+            for flushed, snapshot in snapshots:
+                for key, n in snapshot.items():
+                    flushed[key] = n
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def start(self):
+        if self._thread is None and self._flush is not None:
+            self._thread = threading.Thread(target=self._run, name='counter-flush', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
@@ -0,0 +1,252 @@
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DATASET_DIR = '.datasets'
+CSV_CHUNK_ROWS = 100_000
+MAX_QUERY_ROWS = 10_000
+# Dimensions the labs slice hourly PSD-style tables by, in the order they are grouped
+AGGREGATE_DIMENSIONS = ['geno', 'Drug', 'B', 'CH', 'STG', 'hour']
+# Those of them that are labels, read as text even when they look like numbers
+CATEGORICAL_DIMENSIONS = ['geno', 'Drug', 'B', 'CH', 'STG']
+# Per-group statistics stored for every measure, from which any roll-up's mean and SEM follow
+STATISTICS = ['sum', 'sum_sq', 'n']
+# A long-format table needs at least this many of the dimensions above to be worth ingesting
+MIN_DIMENSIONS = 2
+
+
+class DatasetError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _paths(folder, sha256):
+    base = os.path.join(folder, DATASET_DIR, sha256)
+    return base + '.parquet', base + '.sums.parquet'
+
+
+def is_ingested(folder, attachment):
+    return os.path.exists(_paths(folder, attachment['sha256'])[1])
+
+
+def _read_header(path, sep):
+    import pandas as pd
+
+    return list(pd.read_csv(path, sep=sep, nrows=0).columns)
+
+
+def _column_dtypes(path, sep, dimensions):
+    """
+    One dtype per column, fixed for the whole file from its first chunk so every chunk has the
+    same parquet schema: floats as float64, integers as nullable Int64 so a later missing value
+    does not turn them into floats, and labels and anything else as text.
+    """
+    import pandas as pd
+
+    labels = {column: 'string' for column in dimensions if column in CATEGORICAL_DIMENSIONS}
+    sample = pd.read_csv(path, sep=sep, nrows=CSV_CHUNK_ROWS, dtype=labels)
+    dtypes = {}
+    for column in sample.columns:
+        if column in labels:
+            dtypes[column] = 'string'
+        elif pd.api.types.is_float_dtype(sample[column]):
+            dtypes[column] = 'float64'
+        elif pd.api.types.is_integer_dtype(sample[column]):
+            dtypes[column] = 'Int64'
+        elif pd.api.types.is_bool_dtype(sample[column]):
+            dtypes[column] = 'boolean'
+        else:
+            dtypes[column] = 'string'
+    return dtypes
+
+
+def ingestible(folder, attachment):
+    """
+    Whether an attachment looks like a long-format table of measurements, e.g. psd_hourly.csv
+    with one row per subject_id x geno x Drug x B x hour and PSD/RELPSD values.
+    """
+    sep = {'csv': ',', 'tsv': '\t'}.get(attachment['extension'])
+    if sep is None:
+        return False
+    try:
+        columns = _read_header(os.path.join(folder, attachment['filename']), sep)
+    except (OSError, ValueError):
+        return False
+    return len([column for column in AGGREGATE_DIMENSIONS if column in columns]) >= MIN_DIMENSIONS
+
+
+def ingest(folder, attachment):
+    """
+    Convert a long-format CSV/TSV to parquet chunk by chunk, and precompute the sum, sum of
+    squares and count of every numeric measure grouped by all the dimensions it has, which
+    query_aggregates() rolls up to any coarser grouping. Both are written to folder/.datasets
+    keyed by content hash, so identical uploads are only ingested once.
+    """
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    path = os.path.join(folder, attachment['filename'])
+    sep = '\t' if attachment['extension'] == 'tsv' else ','
+    table_path, aggregates_path = _paths(folder, attachment['sha256'])
+    if os.path.exists(aggregates_path):
+        return
+    os.makedirs(os.path.dirname(table_path), exist_ok=True)
+
+    columns = _read_header(path, sep)
+    dimensions = [column for column in AGGREGATE_DIMENSIONS if column in columns]
+    dtypes = _column_dtypes(path, sep, dimensions)
+    measures = [column for column, dtype in dtypes.items() if column not in dimensions and dtype == 'float64']
+    sums = None
+    writer = None
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(table_path), suffix='.tmp')
+    os.close(fd)
+    try:
+        with pd.read_csv(path, sep=sep, chunksize=CSV_CHUNK_ROWS, dtype=dtypes) as reader:
+            for chunk in reader:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    schema = table.schema
+                    writer = pq.ParquetWriter(tmp_path, schema)
+                writer.write_table(table.cast(schema))
+
+                grouped = chunk.groupby(dimensions, dropna=False)[measures]
+                partial = pd.concat({
+                    'sum': grouped.sum(),
+                    'sum_sq': (chunk[measures] ** 2).groupby([chunk[d] for d in dimensions], dropna=False).sum(),
+                    'n': grouped.count(),
+                }, axis=1)
+                sums = partial if sums is None else sums.add(partial, fill_value=0)
+    except (ValueError, TypeError, pa.ArrowException) as e:
+        # e.g. text further down a column whose first chunk was all numbers
+        if writer is not None:
+            writer.close()
+            writer = None
+        os.remove(tmp_path)
+        raise DatasetError(f"{attachment['filename']} could not be read as a table: {e}", 422)
+    finally:
+        if writer is not None:
+            writer.close()
+    if sums is None:
+        os.remove(tmp_path)
+        raise DatasetError(f"{attachment['filename']} has no rows.")
+    os.replace(tmp_path, table_path)
+
+    aggregates = sums.index.to_frame(index=False)
+    for measure in sums['sum'].columns:
+        for statistic in STATISTICS:
+            aggregates[f'{measure}_{statistic}'] = sums[statistic][measure].to_numpy()
+        aggregates[f'{measure}_n'] = aggregates[f'{measure}_n'].astype(np.int64)
+    # The aggregates file marks the dataset as ingested, so it is moved into place last. Two
+    # workers can ingest the same upload at once, each writes its own temporary file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(aggregates_path), suffix='.tmp')
+    os.close(fd)
+    try:
+        aggregates.to_parquet(tmp_path, index=False)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, aggregates_path)
+    logger.info("Ingested %s into %d aggregate rows", attachment['filename'], len(aggregates))
+
+
+def _cast(schema, column, value):
+    # Numeric columns are compared as numbers, e.g. ?hour=3 for an int64 column
+    field_type = str(schema.field(column).type)
+    if 'int' in field_type:
+        return int(value)
+    if 'double' in field_type or 'float' in field_type:
+        return float(value)
+    return value
+
+
+def _filters(schema, args):
+    """
+    pyarrow filters from query arguments naming a column, e.g. ?geno=A&B=ALPHA,BETA
+    """
+    filters = []
+    for column in schema.names:
+        if column not in args:
+            continue
+        try:
+            values = [_cast(schema, column, value) for value in args[column].split(',')]
+        except ValueError:
+            raise DatasetError(f'Invalid value for {column}.')
+        filters.append((column, 'in', values) if len(values) > 1 else (column, '==', values[0]))
+    return filters or None
+
+
+def _read(path, args, columns=None):
+    import pyarrow.parquet as pq
+
+    if not os.path.exists(path):
+        raise DatasetError('This file has not been ingested.', 404)
+    schema = pq.read_schema(path)
+    if columns is not None:
+        columns = [column for column in columns if column in schema.names] or None
+    return pq.read_table(path, columns=columns, filters=_filters(schema, args))
+
+
+def _columns(args):
+    return args.get('columns', '').split(',')
+
+
+def _page(table, limit):
+    total = table.num_rows
+    table = table.slice(0, limit)
+    return {
+        'columns': table.column_names,
+        'rows': [list(row.values()) for row in table.to_pylist()],
+        'total_rows': total,
+        'truncated': total > limit,
+    }
+
+
+def query_rows(folder, attachment, args):
+    try:
+        limit = min(int(args.get('limit', 1000)), MAX_QUERY_ROWS)
+    except ValueError:
+        raise DatasetError('Invalid limit.')
+    return _page(_read(_paths(folder, attachment['sha256'])[0], args, _columns(args)), limit)
+
+
+def query_aggregates(folder, attachment, args):
+    """
+    Mean, SEM and count of every measure over the rows matching the filters, grouped by the
+    dimensions in ?by=geno,Drug,hour (all of them by default), rolled up from the stored sums.
+    """
+    import pandas as pd
+    import pyarrow as pa
+
+    sums = _read(_paths(folder, attachment['sha256'])[1], args).to_pandas()
+    measures = [column[:-len('_sum')] for column in sums.columns if column.endswith('_sum')]
+    statistics = [f'{measure}_{statistic}' for measure in measures for statistic in STATISTICS]
+    dimensions = [column for column in sums.columns if column not in statistics]
+    by = [column for column in args.get('by', '').split(',') if column] or dimensions
+    unknown = [column for column in by if column not in dimensions]
+    if unknown:
+        raise DatasetError(f"Cannot group by {', '.join(unknown)}, choose from {', '.join(dimensions)}.")
+    sums = sums.groupby(by, dropna=False)[statistics].sum()
+
+    aggregates = sums.index.to_frame(index=False)
+    for measure in measures:
+        total = sums[f'{measure}_sum'].to_numpy()
+        count = sums[f'{measure}_n'].to_numpy()
+        # Groups where a measure is always missing get a NaN mean and SEM rather than a warning
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            variance = (sums[f'{measure}_sum_sq'].to_numpy() - count * mean ** 2) / np.maximum(count - 1, 1)
+            sem = np.sqrt(np.maximum(variance, 0) / count)
+        # Missing rather than NaN, which is not valid JSON
+        aggregates[f'{measure}_mean'] = pd.array(mean, dtype='Float64')
+        aggregates[f'{measure}_sem'] = pd.array(sem, dtype='Float64')
+        aggregates[f'{measure}_n'] = count.astype(np.int64)
+    table = pa.Table.from_pandas(aggregates, preserve_index=False)
+    columns = [column for column in _columns(args) if column in table.column_names]
+    return _page(table.select(columns) if columns else table, MAX_QUERY_ROWS)
@@ -0,0 +1,163 @@
+"""
+HTTP fetching for the scrapers: concurrent, rate-limited per host, and backed by an on-disk
+response cache that is revalidated with ETag/Last-Modified, so an unchanged page costs a 304.
+
+In replay mode the cache is the only source, which makes the whole scrape -> keywords -> posts
+pipeline reproducible offline, e.g. in benchmarks. Record a run once with network access,
+then replay it as often as needed.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = '.http_cache'
+RECORD = 'record'
+REPLAY = 'replay'
+# Be polite: at most this many requests per second to any one host
+REQUESTS_PER_SECOND = 2.0
+MAX_WORKERS = 8
+TIMEOUT = 30
+
+
+class FetchError(Exception):
+    pass
+
+
+class _HostLimiter:
+    """
+    Spaces out the requests to each host so they start at least 1 / rate seconds apart,
+    whichever thread makes them.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class Fetcher:
+    """
+    get(url) returns the body of url as text, or None if the server did not answer 200.
+    get_many(urls) fetches several urls on a thread pool.
+
+    In RECORD mode every response is stored under cache_dir. A cached response younger than
+    max_age seconds is returned as is, an older one is revalidated with a conditional request.
+    In REPLAY mode nothing goes over the network and a url missing from the cache raises
+    FetchError.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, mode=RECORD, max_age=0, rate=REQUESTS_PER_SECOND,
+                 max_workers=MAX_WORKERS, session=None):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f'Unknown fetch mode {mode!r}')
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.max_age = max_age
+        self.max_workers = max_workers
+        self.limiter = _HostLimiter(rate)
+        if session is None and mode == RECORD:
+            import requests
+
+            session = requests.Session()
+        self.session = session
+        self.stats = {'hits': 0, 'revalidated': 0, 'fetched': 0}
+        self._stats_lock = threading.Lock()
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        base = os.path.join(self.cache_dir, key[:2], key)
+        return base + '.json', base + '.body'
+
+    def _read(self, url):
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None, None
+        return meta, body
+
+    def _write(self, url, meta, body=None):
+        meta_path, body_path = self._paths(url)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        # The body goes first, a meta file always has a complete body next to it
+        for path, data in ([(body_path, body)] if body is not None else []) + [(meta_path, json.dumps(meta).encode())]:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def get(self, url):
+        meta, body = self._read(url)
+        if self.mode == REPLAY:
+            if meta is None:
+                raise FetchError(f'{url} was not recorded')
+            self._count('hits')
+            return self._text(meta, body)
+        if meta is not None and time.time() - meta['fetched_at'] < self.max_age:
+            self._count('hits')
+            return self._text(meta, body)
+
+        headers = {}
+        if meta is not None and meta['status'] == 200:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        self.limiter.wait(urlsplit(url).netloc)
+        response = self.session.get(url, headers=headers, timeout=TIMEOUT)
+        if response.status_code == 304 and meta is not None:
+            self._count('revalidated')
+            meta['fetched_at'] = time.time()
+            self._write(url, meta)
+            return self._text(meta, body)
+
+        self._count('fetched')
+        meta = {
+            'url': url,
+            'status': response.status_code,
+            'encoding': response.encoding or 'utf-8',
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched_at': time.time(),
+        }
+        self._write(url, meta, response.content)
+        return self._text(meta, response.content)
+
+    def _text(self, meta, body):
+        if meta['status'] != 200:
+            logger.warning("Failed to get %s: HTTP %d", meta['url'], meta['status'])
+            return None
+        return body.decode(meta['encoding'], errors='replace')
+
+    def get_many(self, urls):
+        """
+        Bodies of urls, in order, fetched with up to max_workers requests in flight.
+        """
+        urls = list(urls)
+        if len(urls) <= 1:
+            return [self.get(url) for url in urls]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls)), thread_name_prefix='fetch') as pool:
+            return list(pool.map(self.get, urls))
@@ -0,0 +1,28 @@
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5001')
+# One worker per core by default, each with a few threads for requests waiting on disk or SQLite
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('THREADS', 4))
+worker_class = 'gthread'
+# Load wsgi.py in the master before forking, so the data and embeddings are read once
+preload_app = True
+# Large downloads are streamed, chunked uploads bound the time a single request takes
+timeout = 120
+accesslog = '-'
+
+
+def pre_fork(server, worker):
+    from app import change_log_pruner, sync_store
+
+    # The worker starts from the master's copy of the store: bring it up to date, and hold back
+    # the pruning of the changes after it until the worker reports its own position
+    sync_store()
+    change_log_pruner.report()
+
+
+def post_fork(server, worker):
+    from app import start_background_tasks
+
+    start_background_tasks()
@@ -0,0 +1,269 @@
+"""
+Opt-in request instrumentation: latency histograms per route, per template and per span,
+served in the Prometheus text format at /metrics, and a sampling profiler that writes the
+stacks of slow requests as folded stacks for flamegraph.pl or speedscope.
+
+Nothing is registered unless app.config['INSTRUMENTATION'] is set. While it is off, span()
+hands out one shared no-op context manager, so the spans left in the code cost a function
+call. Each process keeps its own metrics, so under gunicorn a scrape reads the worker
+that answered it.
+"""
+import functools
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Response, abort, before_render_template, g, request, template_rendered
+
+# Upper bounds of the histogram buckets in seconds, the Prometheus client defaults
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+# How often the profiler samples the stacks of in-flight requests, in seconds
+SAMPLE_INTERVAL = 0.005
+# Innermost frames kept per sampled stack
+MAX_STACK_DEPTH = 64
+
+_enabled = False
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in pairs) + '}'
+
+
+class Metrics:
+    """
+    Histograms keyed by metric name and a tuple of (label, value) pairs.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def observe(self, name, labels, seconds):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = Histogram()
+            histogram.observe(seconds)
+
+    def render(self):
+        with self._lock:
+            series = sorted((key, list(h.buckets), h.count, h.sum) for key, h in self._histograms.items())
+        lines = []
+        previous = None
+        for (name, labels), buckets, count, total in series:
+            if name != previous:
+                if name in self._help:
+                    lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} histogram')
+                previous = name
+            cumulative = 0
+            for bound, n in zip(BUCKETS, buckets):
+                cumulative += n
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('http_request_duration_seconds', 'Time to answer a request, by endpoint, method and status.')
+metrics.describe('template_render_duration_seconds', 'Time to render a template.')
+metrics.describe('span_duration_seconds', 'Time spent in an instrumented block, e.g. a storage call.')
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        metrics.observe('span_duration_seconds', (('span', self.name),), time.perf_counter() - self.start)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name):
+    """
+    with span('similarity.graph'): ... records how long the block took, if instrumentation is on.
+    """
+    return _Span(name) if _enabled else _NO_SPAN
+
+
+def trace_methods(obj, prefix, skip=()):
+    """
+    Wrap every public method of obj but those in skip in a span named prefix.method, e.g.
+    storage.insert_post. Does nothing while instrumentation is off, so obj keeps its plain
+    methods.
+    """
+    if not _enabled:
+        return
+    for name in dir(type(obj)):
+        if name.startswith('_') or name in skip or not callable(getattr(type(obj), name)):
+            continue
+        method = getattr(obj, name)
+
+        def traced(*args, _method=method, _name=f'{prefix}.{name}', **kwargs):
+            with _Span(_name):
+                return _method(*args, **kwargs)
+
+        setattr(obj, name, functools.wraps(method)(traced))
+
+
+def _folded(frame):
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of every thread serving a request each interval seconds. When a request
+    took at least threshold seconds, its samples are appended to path as folded stacks,
+    'endpoint;outer (file:line);...;inner (file:line) count', one line per distinct stack.
+    """
+
+    def __init__(self, path, threshold, interval=SAMPLE_INTERVAL):
+        self.path = path
+        self.threshold = threshold
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, samples in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[_folded(frame)] += 1
+
+    def begin(self):
+        with self._lock:
+            # Checked per process: a thread started before gunicorn forks does not run in the workers
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+                self._thread.start()
+            self._active[threading.get_ident()] = Counter()
+
+    def end(self, endpoint, seconds):
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+        if not samples or seconds < self.threshold:
+            return
+        lines = ''.join(f'{endpoint};{stack} {count}\n' for stack, count in samples.items())
+        with self._lock, open(self.path, 'a') as f:
+            f.write(lines)
+
+
+def init_app(app):
+    """
+    Time every request and template of app, and serve the metrics at /metrics, if
+    app.config['INSTRUMENTATION'] is set. With app.config['PROFILE_SLOW_REQUESTS'] set too,
+    requests slower than that many seconds are profiled into app.config['PROFILE_PATH'].
+
+    /metrics needs an 'Authorization: Bearer <token>' header matching app.config['METRICS_TOKEN'].
+    Without a token it only answers direct requests from the same host, not ones relayed by a
+    proxy.
+    """
+    global _enabled
+    if not app.config.get('INSTRUMENTATION'):
+        return
+    _enabled = True
+    profiler = None
+    if app.config.get('PROFILE_SLOW_REQUESTS') is not None:
+        profiler = SamplingProfiler(app.config['PROFILE_PATH'], app.config['PROFILE_SLOW_REQUESTS'])
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        if profiler:
+            profiler.begin()
+
+    @app.after_request
+    def record_status(response):
+        g.response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def record_request(exc):
+        start = g.pop('request_start', None)
+        if start is None:
+            return
+        seconds = time.perf_counter() - start
+        endpoint = request.endpoint or 'unmatched'
+        labels = (('endpoint', endpoint), ('method', request.method), ('status', g.pop('response_status', 500)))
+        metrics.observe('http_request_duration_seconds', labels, seconds)
+        if profiler:
+            profiler.end(endpoint, seconds)
+
+    def start_template(sender, template, context, **extra):
+        g.setdefault('template_starts', []).append(time.perf_counter())
+
+    def record_template(sender, template, context, **extra):
+        starts = g.get('template_starts')
+        if starts:
+            metrics.observe('template_render_duration_seconds', (('template', template.name),), time.perf_counter() - starts.pop())
+
+    before_render_template.connect(start_template, app, weak=False)
+    template_rendered.connect(record_template, app, weak=False)
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        token = app.config.get('METRICS_TOKEN')
+        if token:
+            if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+                abort(401)
+        elif request.remote_addr not in ('127.0.0.1', '::1') or 'X-Forwarded-For' in request.headers:
+            abort(404)
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
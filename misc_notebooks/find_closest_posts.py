@@ -1,47 +1,585 @@
-import networkx as nx
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import secrets
+import threading
 import numpy as np
 import pandas as pd
 from collections import defaultdict
 import textwrap
-from pyvis.network import Network
-from sklearn.manifold import TSNE
 from gensim.models.doc2vec import Doc2Vec, TaggedDocument
-import spacy
-import pygraphviz
-from bs4 import BeautifulSoup
 import re
 
-DF = pd.read_csv('posts.tsv', sep='\t')
+from nearest_neighbours import NeighbourIndex, normalize
+
+logger = logging.getLogger(__name__)
+
+POSTS_PATH = 'posts.tsv'
+ARTIFACT_DIR = 'embeddings'
+# Bump whenever build_artifact() changes what it writes, so old artifacts get rebuilt
+ARTIFACT_VERSION = 6
+ARTIFACT_COLUMNS = ['Title', 'Keywords', 'Post ID']
+# Posts embedded since the last fit trigger a full refit once they make up this share of the
+# fitted corpus, or once this share of their keywords is unknown to the model. infer_vector
+# ignores unknown words, so the second is a direct measure of how far the posts have drifted.
+REFIT_GROWTH = 0.25
+REFIT_UNKNOWN_WORDS = 0.3
+# Too few new posts say nothing about drift
+REFIT_MIN_POSTS = 20
+# New posts are placed in the t-SNE plane at the mean of this many nearest neighbours
+TSNE_NEIGHBOURS = 5
 NODE_COLOR = {'keyword': 'lightgreen', 'title': 'skyblue'}
+MYNETWORK_CSS_RE = re.compile(r"(#mynetwork\s*{\s*width:\s*)\d+(;\s*height:\s*)\d+(;\s*)")
+MYNETWORK_CSS = r"\1height: 50vh;\n    background-color: #ffffff;\n    border: 1px solid lightgray;\n    position: relative;\n    float: left;\n}"
+CARD_DIV_RE = re.compile(r'(<div\s+class="card"\s+style="width:\s*100%\s*(?:;">)?)')
+
+# Loaded on first use by _load_artifact(), see build_artifact()
+_ARTIFACT = None
+# Post id -> post, see use_posts(). Without one, posts are read from the artifact's posts.tsv
+_GET_POST = None
+_ARTIFACT_POSTS = None
+# Serialises add_posts(), refits and swapping in a reloaded artifact within a process
+_UPDATE_LOCK = threading.RLock()
+
+
+def posts_hash(posts_path: str = POSTS_PATH) -> str:
+    """
+    Content hash of the posts file, used to tell whether the saved embeddings are stale.
+    """
+    sha = hashlib.sha256()
+    with open(posts_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@contextlib.contextmanager
+def _artifact_lock(artifact_dir: str, exclusive: bool):
+    """
+    File lock on artifact_dir, so a process never loads an artifact another one is rewriting.
+    """
+    os.makedirs(artifact_dir, exist_ok=True)
+    with open(os.path.join(artifact_dir, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def _refit_lock(artifact_dir: str):
+    """
+    Non-blocking file lock held while a process refits, yielding whether it was acquired, so
+    the other workers skip the refit and reload its result once meta.json changes.
+    """
+    os.makedirs(artifact_dir, exist_ok=True)
+    with open(os.path.join(artifact_dir, '.refit.lock'), 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _replace(path: str, write) -> None:
+    # Write next to path and move into place: other processes may have the old file memory-mapped
+    tmp_path = path + '.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _post_rows(posts: list) -> pd.DataFrame:
+    return pd.DataFrame(
+        [[post['title'], ' '.join(post['keywords']), post['id']] for post in posts],
+        columns=ARTIFACT_COLUMNS,
+    )
+
+
+def build_artifact(
+    posts_path: str = POSTS_PATH,
+    artifact_dir: str = ARTIFACT_DIR,
+    extra_posts: list = (),
+) -> str:
+    """
+    Train Doc2Vec on the keywords of the posts in posts_path plus extra_posts (post dicts, e.g.
+    everything posted on the site since), infer a vector for every post, project them to 2-D
+    with t-SNE and write everything to artifact_dir:
+
+        posts.tsv     title, keywords and post id of every embedded post
+        vectors.npy   unit-length Doc2Vec vector of every post, one row per post in posts.tsv
+        tsne.npy      2-D t-SNE projection of the vectors
+        doc2vec.model the trained model, so new posts can be embedded without retraining
+        meta.json     content hash of posts_path, a build id and the post id -> row map
+
+    Posts embedded since with add_posts() are saved next to these in added.npz, see
+    _save_additions().
+    """
+    # Only needed to build an artifact, not to query one
+    from sklearn.manifold import TSNE
+
+    content_hash = posts_hash(posts_path)
+    df = pd.read_csv(posts_path, sep='\t')[ARTIFACT_COLUMNS]
+    extra = _post_rows(extra_posts)
+    df = pd.concat([df, extra[~extra['Post ID'].isin(df['Post ID'])]], ignore_index=True)
+    words = [str(keywords).split(" ") for keywords in df["Keywords"]]
+
+    documents = [TaggedDocument(doc, [i]) for i, doc in enumerate(words)]
+    model = Doc2Vec(documents, vector_size=5, window=2, min_count=1, workers=4)
+    X = np.array([model.infer_vector(words[i]) for i in range(len(words))], dtype=np.float32)
+    X_embedded = TSNE(n_components=2, perplexity=min(30, len(X) - 1)).fit_transform(X).astype(np.float32)
+
+    post_id_to_row = {str(post_id): row for row, post_id in enumerate(df['Post ID'])}
+    meta = {
+        'version': ARTIFACT_VERSION,
+        'posts_hash': content_hash,
+        # Ties added.npz to the fit its vectors were inferred with
+        'build_id': secrets.token_hex(8),
+        'post_id_to_row': post_id_to_row,
+    }
+
+    def save_array(array):
+        def write(path):
+            with open(path, 'wb') as f:
+                np.save(f, array)
+        return write
+
+    def save_meta(path):
+        with open(path, 'w') as f:
+            json.dump(meta, f)
+
+    with _artifact_lock(artifact_dir, exclusive=True):
+        _replace(os.path.join(artifact_dir, 'posts.tsv'), lambda path: df.to_csv(path, sep='\t', index=False))
+        _replace(os.path.join(artifact_dir, 'vectors.npy'), save_array(normalize(X)))
+        _replace(os.path.join(artifact_dir, 'tsne.npy'), save_array(X_embedded))
+        _replace(os.path.join(artifact_dir, 'doc2vec.model'), model.save)
+        # meta.json is written last so a half-written artifact is never mistaken for a complete one
+        _replace(os.path.join(artifact_dir, 'meta.json'), save_meta)
+    return content_hash
+
+
+def _read_meta(artifact_dir: str):
+    try:
+        with open(os.path.join(artifact_dir, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _signature(posts_path: str, artifact_dir: str) -> tuple:
+    stat = os.stat(posts_path)
+    try:
+        meta_mtime = os.stat(os.path.join(artifact_dir, 'meta.json')).st_mtime_ns
+    except OSError:
+        meta_mtime = None
+    return stat.st_size, stat.st_mtime_ns, meta_mtime
+
+
+def _load_artifact(
+    posts_path: str = POSTS_PATH,
+    artifact_dir: str = ARTIFACT_DIR,
+) -> dict:
+    """
+    Return the embedding artifact, building it first if it is missing or was built from a
+    different posts.tsv, and reloading it when another process refitted it. The hash is only
+    recomputed when the file's size or mtime changes.
+    """
+    artifact = _ARTIFACT
+    if artifact is not None and artifact['signature'] == _signature(posts_path, artifact_dir):
+        return artifact
+    # Swapped under the lock, so add_posts() never appends to an artifact that is being replaced
+    with _UPDATE_LOCK:
+        return _reload_artifact(posts_path, artifact_dir)
+
+
+def _reload_artifact(posts_path: str, artifact_dir: str) -> dict:
+    global _ARTIFACT, _ARTIFACT_POSTS
+    signature = _signature(posts_path, artifact_dir)
+    if _ARTIFACT is not None and _ARTIFACT['signature'] == signature:
+        return _ARTIFACT
+
+    content_hash = posts_hash(posts_path)
+    if _ARTIFACT is not None and _ARTIFACT['posts_hash'] == content_hash and _ARTIFACT['signature'][2] == signature[2]:
+        _ARTIFACT['signature'] = signature
+        return _ARTIFACT
+
+    meta = _read_meta(artifact_dir)
+    if meta is None or meta.get('version') != ARTIFACT_VERSION or meta['posts_hash'] != content_hash:
+        build_artifact(posts_path, artifact_dir)
+
+    with _artifact_lock(artifact_dir, exclusive=False):
+        meta = _read_meta(artifact_dir)
+        signature = signature[:2] + (os.stat(os.path.join(artifact_dir, 'meta.json')).st_mtime_ns,)
+        vectors = np.load(os.path.join(artifact_dir, 'vectors.npy'), mmap_mode='r')
+        post_ids = np.empty(len(vectors), dtype=np.int64)
+        for post_id, row in meta['post_id_to_row'].items():
+            post_ids[row] = int(post_id)
+        artifact = {
+            'signature': signature,
+            'posts_hash': meta['posts_hash'],
+            'build_id': meta['build_id'],
+            'artifact_dir': artifact_dir,
+            # Rows are mapped to post ids only, the posts themselves come from _get_post()
+            'post_ids': post_ids,
+            'post_id_to_row': {int(post_id): row for post_id, row in meta['post_id_to_row'].items()},
+            # Title -> post id of the first post with that title, see _post_id_for_title()
+            'post_id_for_title': None,
+            'vectors': vectors,
+            'tsne': np.load(os.path.join(artifact_dir, 'tsne.npy')),
+            'index': NeighbourIndex(vectors, normalized=True),
+            'model': Doc2Vec.load(os.path.join(artifact_dir, 'doc2vec.model')),
+            'fitted_rows': len(vectors),
+            # Vectors of the posts embedded since the fit, and the mtime of added.npz when read
+            'added_vectors': np.empty((0, vectors.shape[1]), dtype=np.float32),
+            'additions_mtime': None,
+            # Counts over the posts embedded with infer_vector since the fit, see needs_refit()
+            'added': 0,
+            'words': 0,
+            'unknown_words': 0,
+        }
+    _load_additions(artifact)
+    _ARTIFACT_POSTS = None
+    _ARTIFACT = artifact
+    return _ARTIFACT
+
+
+def load_embeddings(posts_path: str = POSTS_PATH, artifact_dir: str = ARTIFACT_DIR) -> None:
+    """
+    Load the embedding artifact now rather than on the first query, e.g. in a server's
+    master process so forked workers share it copy-on-write.
+    """
+    _load_artifact(posts_path, artifact_dir)
+
+
+def use_posts(get_post) -> None:
+    """
+    Look posts up with get_post(post_id), e.g. the app's Store.get_post, instead of keeping a
+    second copy of the corpus here.
+    """
+    global _GET_POST
+    _GET_POST = get_post
+
+
+def _artifact_posts() -> dict:
+    """
+    Post id -> {'id', 'title', 'keywords'} read from the artifact's posts.tsv, for use without
+    use_posts(), e.g. from a notebook.
+    """
+    global _ARTIFACT_POSTS
+    if _ARTIFACT_POSTS is None:
+        df = pd.read_csv(os.path.join(_load_artifact()['artifact_dir'], 'posts.tsv'), sep='\t')
+        _ARTIFACT_POSTS = {
+            int(post_id): {'id': int(post_id), 'title': title, 'keywords': str(keywords).split(" ")}
+            for title, keywords, post_id in df[ARTIFACT_COLUMNS].itertuples(index=False)
+        }
+    return _ARTIFACT_POSTS
+
 
+def _get_post(post_id: int):
+    return _GET_POST(post_id) if _GET_POST is not None else _artifact_posts().get(post_id)
 
-# create word list from posts
-nlp = spacy.load('en_core_web_sm')
-words = []
-for i, row in DF.iterrows():
-    words.append(row["Keywords"].split(" "))
 
-documents = [TaggedDocument(doc, [i]) for i, doc in enumerate(words)]
-model = Doc2Vec(documents, vector_size=5, window=2, min_count=1, workers=4)
+def _post_id_for_title(title: str) -> int:
+    artifact = _load_artifact()
+    if artifact['post_id_for_title'] is None:
+        # Built on the first title query only, the app itself looks posts up by id
+        post_id_for_title = {}
+        for post_id in artifact['post_ids'].tolist():
+            post = _get_post(post_id)
+            if post is not None:
+                post_id_for_title.setdefault(post['title'], post_id)
+        artifact['post_id_for_title'] = post_id_for_title
+    return artifact['post_id_for_title'][title]
 
-# plot the t-SNE of the embeddings of the descriptions
-X = np.array([model.infer_vector(words[i]) for i in range(len(words))])
-X_embedded = TSNE(n_components=2).fit_transform(X)
+
+def _append(artifact: dict, post_ids: list, vectors: np.ndarray, placed: np.ndarray) -> None:
+    # Queries run concurrently and map the rows they find through post_ids, so the new rows
+    # get their post ids and t-SNE points before the index can return them, and the posts
+    # only become queryable by id once they are in the index
+    artifact['tsne'] = np.concatenate([artifact['tsne'], placed])
+    artifact['post_ids'] = np.concatenate([artifact['post_ids'], post_ids])
+    artifact['added_vectors'] = np.concatenate([artifact['added_vectors'], vectors])
+    rows = artifact['index'].add(vectors)
+    for post_id, row in zip(post_ids, rows.tolist()):
+        artifact['post_id_to_row'][post_id] = row
+    artifact['added'] += len(post_ids)
+
+
+def _save_additions(artifact: dict) -> None:
+    """
+    Write the posts embedded since the fit to added.npz, so other processes load their vectors
+    rather than inferring them again. infer_vector is not deterministic, and a post must have
+    the same neighbours whichever worker answers.
+    """
+    fitted = artifact['fitted_rows']
+
+    def write(path):
+        with open(path, 'wb') as f:
+            np.savez(f, build_id=artifact['build_id'], post_ids=artifact['post_ids'][fitted:],
+                     vectors=artifact['added_vectors'], tsne=artifact['tsne'][fitted:],
+                     words=artifact['words'], unknown_words=artifact['unknown_words'])
+
+    path = os.path.join(artifact['artifact_dir'], 'added.npz')
+    with _artifact_lock(artifact['artifact_dir'], exclusive=True):
+        _replace(path, write)
+        artifact['additions_mtime'] = os.stat(path).st_mtime_ns
+
+
+def _load_additions(artifact: dict) -> int:
+    """
+    Append the posts another process embedded since the fit, see _save_additions(). Returns
+    how many were added.
+    """
+    path = os.path.join(artifact['artifact_dir'], 'added.npz')
+    with _artifact_lock(artifact['artifact_dir'], exclusive=False):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+        if mtime == artifact['additions_mtime']:
+            return 0
+        with np.load(path) as additions:
+            if str(additions['build_id']) != artifact['build_id']:
+                return 0
+            post_ids = additions['post_ids'].tolist()
+            new = [i for i, post_id in enumerate(post_ids) if post_id not in artifact['post_id_to_row']]
+            if new:
+                _append(artifact, [post_ids[i] for i in new], additions['vectors'][new], additions['tsne'][new])
+                artifact['post_id_for_title'] = None
+            artifact['words'] = max(artifact['words'], int(additions['words']))
+            artifact['unknown_words'] = max(artifact['unknown_words'], int(additions['unknown_words']))
+        artifact['additions_mtime'] = mtime
+    return len(new)
+
+
+def load_additions() -> int:
+    """
+    Pick up the posts another process embedded with add_posts(), see _save_additions().
+    """
+    with _UPDATE_LOCK:
+        return _load_additions(_load_artifact())
+
+
+def add_posts(posts: list) -> int:
+    """
+    Embed posts (post records or dicts) that are not in the artifact yet with infer_vector and append
+    them to the neighbour index, without retraining, and save their vectors for other processes.
+    Returns how many were added.
+    """
+    with _UPDATE_LOCK:
+        artifact = _load_artifact()
+        _load_additions(artifact)
+        posts = [post for post in posts if post['id'] not in artifact['post_id_to_row']]
+        if not posts:
+            return 0
+        model = artifact['model']
+        words = [list(post['keywords']) for post in posts]
+        vectors = normalize(np.array([model.infer_vector(doc) for doc in words], dtype=np.float32))
+
+        # Placed among their neighbours already in the index, which all have a t-SNE point
+        tsne = artifact['tsne']
+        neighbours = artifact['index'].query(vectors, TSNE_NEIGHBOURS)
+        placed = [tsne[found[found >= 0]] for found in neighbours]
+        placed = np.array([points.mean(axis=0) if len(points) else np.zeros(2) for points in placed], dtype=np.float32)
+        _append(artifact, [post['id'] for post in posts], vectors, placed)
+        if _ARTIFACT_POSTS is not None:
+            for post in posts:
+                _ARTIFACT_POSTS[post['id']] = {'id': post['id'], 'title': post['title'], 'keywords': list(post['keywords'])}
+        if artifact['post_id_for_title'] is not None:
+            for post in posts:
+                artifact['post_id_for_title'].setdefault(post['title'], post['id'])
+
+        artifact['words'] += sum(len(doc) for doc in words)
+        artifact['unknown_words'] += sum(word not in model.wv.key_to_index for doc in words for word in doc)
+        _save_additions(artifact)
+        return len(posts)
+
+
+def needs_refit() -> bool:
+    """
+    Whether enough posts were added since the last fit, or their vocabulary drifted far enough
+    from the model's, to be worth a full refit. See REFIT_GROWTH and REFIT_UNKNOWN_WORDS.
+    """
+    artifact = _load_artifact()
+    if artifact['added'] < REFIT_MIN_POSTS:
+        return False
+    grown = artifact['added'] / max(artifact['fitted_rows'], 1) >= REFIT_GROWTH
+    drifted = artifact['unknown_words'] / max(artifact['words'], 1) >= REFIT_UNKNOWN_WORDS
+    return grown or drifted
+
+
+def refit(posts: list) -> bool:
+    """
+    Retrain the artifact on posts.tsv plus posts and load it. Only one process refits at a
+    time: returns False without refitting if another one is, or already did since this
+    process last loaded the artifact.
+    """
+    with _UPDATE_LOCK, _refit_lock(ARTIFACT_DIR) as acquired:
+        # Reloading picks up a refit that finished just before the lock was taken
+        if not acquired or not needs_refit():
+            return False
+        logger.info("Refitting the post embeddings on %d posts", len(posts))
+        build_artifact(POSTS_PATH, ARTIFACT_DIR, extra_posts=posts)
+        _load_artifact()
+        return True
+
+
+class EmbeddingUpdater:
+    """
+    Background worker keeping the embeddings in step with the site: every interval seconds, or
+    as soon as notify() is called, the posts returned by get_posts() that have no embedding yet
+    are added with add_posts(), and the artifact is refitted if needs_refit() says so.
+    on_change() is called whenever that changed anyone's neighbours.
+
+    Under several worker processes only one embeds and refits: the first to take a file lock
+    in the artifact directory keeps it while it lives. The others load the vectors it saves
+    with load_additions() and its refits by reloading the artifact. If it exits, another one
+    takes over.
+    """
+
+    def __init__(self, get_posts, interval: float = 60, on_change=None):
+        self.get_posts = get_posts
+        self.interval = interval
+        self.on_change = on_change
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._artifact = None
+        self._lock_file = None
+        self._leading = False
+
+    def notify(self):
+        self._wake.set()
+
+    def _lead(self) -> bool:
+        if not self._leading:
+            if self._lock_file is None:
+                os.makedirs(ARTIFACT_DIR, exist_ok=True)
+                self._lock_file = open(os.path.join(ARTIFACT_DIR, '.updater.lock'), 'a')
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._leading = True
+            except BlockingIOError:
+                pass
+        return self._leading
+
+    def update(self):
+        loaded = load_additions()
+        added = refitted = 0
+        if self._lead():
+            posts = self.get_posts()
+            added = add_posts(posts)
+            if added:
+                logger.info("Embedded %d new posts", added)
+            refitted = needs_refit() and refit(posts)
+        # A refit by another process is picked up by reloading the artifact
+        artifact = _load_artifact()
+        reloaded = artifact is not self._artifact
+        self._artifact = artifact
+        if (loaded or added or refitted or reloaded) and self.on_change:
+            self.on_change()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.update()
+            except Exception:
+                logger.exception("Could not update the post embeddings")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='embedding-updater', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+
+def get_closest_posts(
+    post_ids: list = (),
+    n_closest: int = 5,
+    titles: list = (),
+) -> list:
+    """
+    The posts closest to each post id (then each title), as one list of posts per query,
+    found with a single query against the Doc2Vec neighbour index.
+    """
+    artifact = _load_artifact()
+    post_ids = list(post_ids) + [_post_id_for_title(title) for title in titles]
+    rows = [artifact['post_id_to_row'][post_id] for post_id in post_ids]
+    # n_closest counts the post itself, as the t-SNE argsort version did
+    neighbours = artifact['index'].query_rows(rows, n_closest - 1)
+    found_ids = [artifact['post_ids'][found[found >= 0]].tolist() for found in neighbours]
+    return [[post for post in map(_get_post, ids) if post is not None] for ids in found_ids]
 
 
 def get_closest_df(
-    title: dict,
+    title: str,
     n_closest: int = 5,
 ) -> pd.DataFrame:
     """
+    Title and Keywords of the posts whose Doc2Vec vectors are closest to the post with the
+    given title, as a DataFrame like the rows of posts.tsv.
+    """
+    return pd.DataFrame(
+        [[post['title'], ' '.join(post['keywords'])] for post in get_closest_posts(titles=[title], n_closest=n_closest)[0]],
+        columns=['Title', 'Keywords'],
+    )
+
+
+def get_closest_posts_graph(
+    post_title: str = None,
+    post_id: int = None,
+) -> dict:
+    """
+    Keyword/title graph of the posts closest to post_id (or the post titled post_title) as
+    vis-network nodes and edges:
+
+        {'nodes': [{'id', 'label', 'type'}], 'edges': [{'from', 'to'}]}
 
+    type is 'keyword' or 'title'. Layout is left to the browser, only keywords and titles
+    are sent.
     """
-    idx = DF[DF['Title'] == title].index[0]
-    x = X_embedded[idx]
-    distances = np.linalg.norm(X_embedded - x, axis=1)
-    closest = distances.argsort()[1:n_closest]
+    if post_id is not None:
+        closest = get_closest_posts([post_id])[0]
+    else:
+        closest = get_closest_posts(titles=[post_title])[0]
+    attributes = defaultdict(set)
+    for post in closest:
+        for keyword in post['keywords']:
+            attributes[keyword].add(textwrap.fill(post['title'], width=20))
+    titles = sorted(set().union(*attributes.values()))
+    nodes = [{'id': keyword, 'label': keyword, 'type': 'keyword'} for keyword in attributes]
+    # A keyword and a title can share a name, give the titles their own id space
+    nodes += [{'id': 't:' + title, 'label': title, 'type': 'title'} for title in titles]
+    edges = [
+        {'from': 't:' + title, 'to': keyword}
+        for keyword, related_titles in attributes.items()
+        for title in sorted(related_titles)
+    ]
+    return {'nodes': nodes, 'edges': edges}
 
-    return DF.iloc[closest]
+
+def _element(html_code: str, tag: str) -> str:
+    """
+    Return the <tag>...</tag> element of a pyvis page, which only ever has one head and one body.
+    """
+    start = html_code.find(f'<{tag}')
+    end = html_code.rfind(f'</{tag}>')
+    if start == -1 or end == -1:
+        return ''
+    return html_code[start:end + len(tag) + 3]
 
 
 def get_closest_posts_plot_html(
@@ -70,6 +608,9 @@ def get_closest_posts_plot_html(
         'likes'
     }
     """
+    import networkx as nx
+    from pyvis.network import Network
+
     G = nx.Graph()
     attributes = defaultdict(list)
     closest_df = get_closest_df(post_title)
@@ -88,9 +629,7 @@ def get_closest_posts_plot_html(
         for title in related_titles:
             wrapped_title = textwrap.fill(title, width=20)
             G.add_edge(wrapped_title, keyword)
-    # Draw the graph
-    pos = nx.nx_agraph.graphviz_layout(G, "sfdp")
-    #plt.figure(figsize=(40, 40))
+    # The layout is left to the barnes_hut physics in the browser
     node_size = {'keyword': 10, 'title': 15}
     # Assign node attributes for color and size
     for node, data in G.nodes(data=True):
@@ -106,18 +645,18 @@ def get_closest_posts_plot_html(
             g.add_node(node, size=80, color='lightgreen', font={'size': 100})
     for edge in G.edges():
         g.add_edge(edge[0], edge[1], width=12)
-    g.show('ex.html')
-    with open('ex.html', 'r') as file:
-        html_code = file.read()
-        regex_pattern = r"(#mynetwork\s*{\s*width:\s*)\d+(;\s*height:\s*)\d+(;\s*)"
-        replacement_string = r"\1height: 50vh;\n    background-color: #ffffff;\n    border: 1px solid lightgray;\n    position: relative;\n    float: left;\n}"
-        html_code = re.sub(regex_pattern, replacement_string, html_code)
-        regex_pattern = r'(<div\s+class="card"\s+style="width:\s*100%\s*(?:;">)?)'
-        replacement_string = r'\1 height: 45vh;'
-        html_code = re.sub(regex_pattern, replacement_string, html_code)
-        # Apply regex substitution to modify the CSS block
-        
-        soup = BeautifulSoup(html_code, 'html.parser')
-        html_code = soup.find("head").prettify() + soup.find("body").prettify()
-
-    return html_code
+    # Render straight to a string, writing to a shared ex.html raced between concurrent requests
+    html_code = g.generate_html(notebook=True)
+    html_code = MYNETWORK_CSS_RE.sub(MYNETWORK_CSS, html_code)
+    html_code = CARD_DIV_RE.sub(r'\1 height: 45vh;', html_code)
+
+    return _element(html_code, 'head') + _element(html_code, 'body')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the post embeddings used to find closest posts.')
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('--posts', default=POSTS_PATH, help='posts file to embed')
+    parser.add_argument('--out', default=ARTIFACT_DIR, help='directory to write the artifact to')
+    args = parser.parse_args()
+    print(f"Built embeddings for posts.tsv hash {build_artifact(args.posts, args.out)} in {args.out}/")
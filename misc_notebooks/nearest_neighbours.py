@@ -0,0 +1,162 @@
+import numpy as np
+
+# Below this many vectors an exact scan is faster than probing an IVF index
+BRUTE_FORCE_LIMIT = 50_000
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scale vectors to unit length, as NeighbourIndex stores them. Zero vectors are left as is.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Column indices of the k highest scores in every row, best first, via argpartition.
+    """
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1)
+    return np.take_along_axis(part, order, axis=1)
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, chunk: int = 65_536) -> np.ndarray:
+    return np.concatenate([
+        np.argmax(vectors[i:i + chunk] @ centroids.T, axis=1)
+        for i in range(0, len(vectors), chunk)
+    ]) if len(vectors) else np.empty(0, dtype=np.int64)
+
+
+class NeighbourIndex:
+    """
+    Cosine-similarity nearest neighbour index over post embeddings.
+
+    Small corpora are searched exactly with one matrix product and an argpartition top-k.
+    Once the corpus passes BRUTE_FORCE_LIMIT vectors an IVF index is trained: vectors are
+    bucketed by their nearest k-means centroid and a query only scans the n_probe closest
+    buckets.
+
+    Pass normalized=True for vectors already scaled with normalize(), e.g. memory-mapped
+    from disk, to use them as they are rather than copying them into memory. Vectors added
+    later go to a separate in-memory tail, so the memory map is never copied either.
+    """
+
+    def __init__(
+        self,
+        vectors: np.ndarray,
+        brute_force_limit: int = BRUTE_FORCE_LIMIT,
+        n_probe: int = 16,
+        normalized: bool = False,
+    ):
+        self.vectors = vectors if normalized else normalize(vectors)
+        self.tail = np.empty((0, self.vectors.shape[1]), dtype=np.float32)
+        self.brute_force_limit = brute_force_limit
+        self.n_probe = n_probe
+        self.centroids = None
+        self.lists = None
+        if len(self.vectors) > brute_force_limit:
+            self._train_ivf()
+
+    def __len__(self):
+        return len(self.vectors) + len(self.tail)
+
+    def _take(self, rows: np.ndarray) -> np.ndarray:
+        # Rows past the end of vectors are in the tail
+        vectors, tail = self.vectors, self.tail
+        rows = np.asarray(rows, dtype=np.int64)
+        in_tail = rows >= len(vectors)
+        if not in_tail.any():
+            return vectors[rows]
+        taken = np.empty((len(rows), vectors.shape[1]), dtype=np.float32)
+        taken[~in_tail] = vectors[rows[~in_tail]]
+        taken[in_tail] = tail[rows[in_tail] - len(vectors)]
+        return taken
+
+    def _train_ivf(self, n_iter: int = 10, seed: int = 0):
+        n = len(self)
+        n_lists = max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        # Train the centroids on a sample, there is no need to run k-means over a million posts
+        sample = self._take(rng.choice(n, size=min(n, n_lists * 64), replace=False))
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = sample[assignment == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            centroids = normalize(centroids)
+        assignment = np.concatenate([_assign(self.vectors, centroids), _assign(self.tail, centroids)])
+        order = np.argsort(assignment, kind='stable')
+        bounds = np.searchsorted(assignment[order], np.arange(n_lists + 1))
+        # Queries take the IVF path once centroids is set, so the lists must be in place first
+        self.lists = [list(order[bounds[c]:bounds[c + 1]]) for c in range(n_lists)]
+        self.centroids = centroids
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Append vectors to the index without retraining and return their row numbers.
+        """
+        vectors = normalize(np.atleast_2d(vectors))
+        first = len(self)
+        self.tail = np.concatenate([self.tail, vectors])
+        if self.centroids is not None:
+            for row, c in enumerate(_assign(vectors, self.centroids), start=first):
+                self.lists[c].append(row)
+        elif len(self) > self.brute_force_limit:
+            self._train_ivf()
+        return np.arange(first, first + len(vectors))
+
+    def query(
+        self,
+        queries: np.ndarray,
+        k: int = 5,
+        exclude_rows=None,
+    ) -> np.ndarray:
+        """
+        Return the rows of the k nearest vectors for every query vector, best first. Rows the
+        IVF probe could not fill are -1. exclude_rows gives, per query, a row to leave out
+        (usually the query's own row).
+        """
+        queries = normalize(np.atleast_2d(queries))
+        extra = 0 if exclude_rows is None else 1
+        if self.centroids is None:
+            vectors, tail = self.vectors, self.tail
+            scores = queries @ vectors.T
+            if len(tail):
+                scores = np.concatenate([scores, queries @ tail.T], axis=1)
+            found = _top_k(scores, k + extra)
+        else:
+            found = self._query_ivf(queries, k + extra)
+        if exclude_rows is None:
+            return found
+        width = max(0, min(k, found.shape[1] - extra))
+        return np.array([
+            [row for row in rows if row != skip][:width]
+            for rows, skip in zip(found.tolist(), exclude_rows)
+        ], dtype=np.int64).reshape(len(queries), width)
+
+    def _query_ivf(self, queries: np.ndarray, k: int) -> np.ndarray:
+        probes = _top_k(queries @ self.centroids.T, self.n_probe)
+        results = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, (query, lists) in enumerate(zip(queries, probes)):
+            candidates = np.fromiter(
+                (row for c in lists for row in self.lists[c]), dtype=np.int64)
+            if not len(candidates):
+                continue
+            best = _top_k((self._take(candidates) @ query)[None, :], k)[0]
+            results[i, :len(best)] = candidates[best]
+        return results
+
+    def query_rows(self, rows, k: int = 5) -> np.ndarray:
+        """
+        Batch query by row number, leaving each row out of its own neighbours.
+        """
+        rows = list(rows)
+        return self.query(self._take(rows), k, exclude_rows=rows)
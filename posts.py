@@ -0,0 +1,55 @@
+import sys
+
+from storage import POST_FIELDS
+
+# Fields with few distinct values, e.g. organism 'Homo sapiens' or usage restrictions 'Public',
+# which are interned so a million posts share one copy of each value
+CATEGORICAL_FIELDS = frozenset([
+    'dataset_type', 'collection_period', 'organism', 'tissue_celltype', 'condition', 'technique',
+    'instrument_platform', 'software', 'usage_restrictions', 'related_datasets', 'user',
+])
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Post:
+    """
+    One post, with a slot per field instead of a per-post dict, categorical values and keywords
+    interned, and keywords kept as a tuple. The app, the search index and the closest-posts
+    module all hold the same Post objects.
+
+    Fields read as attributes (post.title) or, like the dicts posts used to be, as items
+    (post['title']), and dict(post) gives a plain dict.
+    """
+
+    __slots__ = tuple(POST_FIELDS)
+
+    def __init__(self, **fields):
+        for field in POST_FIELDS:
+            value = fields.get(field)
+            setattr(self, field, _intern(value) if field in CATEGORICAL_FIELDS else value)
+        self.keywords = tuple(sys.intern(keyword) for keyword in self.keywords or ())
+        self.likes = self.likes or 0
+
+    def keys(self):
+        return POST_FIELDS
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in POST_FIELDS
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def __repr__(self):
+        return f'Post(id={self.id!r}, title={self.title!r})'
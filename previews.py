@@ -0,0 +1,247 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+
+PREVIEW_DIR = '.previews'
+# Bump whenever the preview format changes, so cached previews get regenerated
+PREVIEW_VERSION = 1
+PREVIEW_ROWS = 20
+CSV_CHUNK_ROWS = 50_000
+# Column statistics stop after this many rows, so a huge table still previews in bounded time
+MAX_STAT_ROWS = 2_000_000
+EDF_POINTS_PER_CHANNEL = 1_000
+
+
+class PreviewError(Exception):
+    pass
+
+
+def _json_value(value):
+    """Convert a table cell to something json can write, such as None for NA, NaN and NaT."""
+    import pandas as pd
+
+    if value is None or (np.ndim(value) == 0 and pd.isna(value)):
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return str(value)
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+class _ColumnStats:
+    """
+    Running count, missing values, min, max, mean and standard deviation of one column,
+    updated chunk by chunk.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.missing = 0
+        self.numeric = True
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min = None
+        self.max = None
+
+    def update(self, values):
+        import pandas as pd
+
+        self.missing += int(values.isna().sum())
+        values = values.dropna()
+        self.count += len(values)
+        if not self.numeric or not len(values):
+            return
+        if not pd.api.types.is_numeric_dtype(values):
+            self.numeric = False
+            return
+        values = values.astype('float64')
+        self.total += float(values.sum())
+        self.total_sq += float((values ** 2).sum())
+        low, high = float(values.min()), float(values.max())
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def summary(self):
+        summary = {'count': self.count, 'missing': self.missing, 'numeric': self.numeric and self.min is not None}
+        if summary['numeric']:
+            mean = self.total / self.count
+            summary.update(
+                min=self.min,
+                max=self.max,
+                mean=mean,
+                std=max(0.0, self.total_sq / self.count - mean ** 2) ** 0.5,
+            )
+        return summary
+
+
+def _table_preview(chunks, n_rows):
+    columns, rows, stats, scanned = None, [], {}, 0
+    for chunk in chunks:
+        if columns is None:
+            columns = [str(column) for column in chunk.columns]
+            stats = {column: _ColumnStats() for column in columns}
+        if len(rows) < n_rows:
+            head = chunk.head(n_rows - len(rows))
+            rows += [[_json_value(value) for value in row] for row in head.itertuples(index=False)]
+        for column, values in zip(columns, chunk.columns):
+            stats[column].update(chunk[values])
+        scanned += len(chunk)
+        if scanned >= MAX_STAT_ROWS:
+            break
+    return {
+        'kind': 'table',
+        'columns': columns or [],
+        'rows': rows,
+        'stats': {column: column_stats.summary() for column, column_stats in stats.items()},
+        'rows_scanned': scanned,
+        'complete': scanned < MAX_STAT_ROWS,
+    }
+
+
+def preview_csv(path, sep=',', n_rows=PREVIEW_ROWS):
+    import pandas as pd
+
+    with pd.read_csv(path, sep=sep, chunksize=CSV_CHUNK_ROWS, low_memory=True) as reader:
+        return _table_preview(reader, n_rows)
+
+
+def preview_parquet(path, n_rows=PREVIEW_ROWS):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise PreviewError('Previewing parquet files requires pyarrow.')
+    parquet_file = pq.ParquetFile(path)
+    return _table_preview((batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=CSV_CHUNK_ROWS)), n_rows)
+
+
+def _edf_header(path):
+    with open(path, 'rb') as f:
+        header = f.read(256)
+        if len(header) < 256:
+            raise PreviewError('Not an EDF file.')
+        header_bytes = int(header[184:192])
+        n_records = int(header[236:244])
+        record_duration = float(header[244:252])
+        n_signals = int(header[252:256])
+        signal_header = f.read(256 * n_signals)
+
+    def field(offset, width):
+        start = offset * n_signals
+        return [signal_header[start + i * width:start + (i + 1) * width].decode('ascii', 'replace').strip()
+                for i in range(n_signals)]
+
+    # Signal header fields are stored field by field, each repeated for every signal
+    labels = field(0, 16)
+    units = field(16 + 80, 8)
+    physical_min = [float(v) for v in field(16 + 80 + 8, 8)]
+    physical_max = [float(v) for v in field(16 + 80 + 16, 8)]
+    digital_min = [float(v) for v in field(16 + 80 + 24, 8)]
+    digital_max = [float(v) for v in field(16 + 80 + 32, 8)]
+    samples = [int(v) for v in field(16 + 80 + 40 + 80, 8)]
+    return {
+        'header_bytes': header_bytes,
+        'n_records': n_records,
+        'record_duration': record_duration,
+        'labels': labels,
+        'units': units,
+        'physical_min': physical_min,
+        'physical_max': physical_max,
+        'digital_min': digital_min,
+        'digital_max': digital_max,
+        'samples': samples,
+    }
+
+
+def preview_edf(path, points=EDF_POINTS_PER_CHANNEL):
+    """
+    Decimated per-channel traces of an EDF recording. The data records are memory-mapped and
+    only the picked samples are read, so the preview costs the same for a 10 MB and a 10 GB file.
+    """
+    header = _edf_header(path)
+    record_size = sum(header['samples'])
+    n_records = header['n_records']
+    if n_records < 0:
+        # Recordings that were not closed properly leave the record count at -1
+        n_records = (os.path.getsize(path) - header['header_bytes']) // (2 * record_size)
+    data = np.memmap(path, dtype='<i2', mode='r', offset=header['header_bytes'], shape=(n_records, record_size))
+
+    channels = []
+    offset = 0
+    for i, label in enumerate(header['labels']):
+        per_record = header['samples'][i]
+        if label == 'EDF Annotations':
+            offset += per_record
+            continue
+        total = n_records * per_record
+        picks = np.linspace(0, total - 1, num=min(points, total)).astype(np.int64) if total else np.empty(0, dtype=np.int64)
+        digital = data[picks // per_record, offset + picks % per_record].astype(np.float64)
+        scale = (header['physical_max'][i] - header['physical_min'][i]) / ((header['digital_max'][i] - header['digital_min'][i]) or 1)
+        physical = (digital - header['digital_min'][i]) * scale + header['physical_min'][i]
+        sample_rate = per_record / header['record_duration'] if header['record_duration'] else None
+        channels.append({
+            'label': label,
+            'unit': header['units'][i],
+            'sample_rate': sample_rate,
+            'n_samples': total,
+            'time': (picks / sample_rate).round(6).tolist() if sample_rate else picks.tolist(),
+            'values': physical.round(6).tolist(),
+        })
+        offset += per_record
+    return {
+        'kind': 'signal',
+        'n_records': n_records,
+        'duration': n_records * header['record_duration'],
+        'channels': channels,
+    }
+
+
+PREVIEWERS = {
+    'csv': lambda path: preview_csv(path, sep=','),
+    'tsv': lambda path: preview_csv(path, sep='\t'),
+    'parquet': preview_parquet,
+    'edf': preview_edf,
+}
+
+
+def can_preview(filename):
+    return bool(filename) and '.' in filename and filename.rsplit('.', 1)[1].lower() in PREVIEWERS
+
+
+def get_preview(folder, attachment):
+    """
+    Preview of an uploaded file, generated once per content hash and cached as JSON under
+    folder/.previews, so the same data uploaded twice or viewed again is never re-read.
+    """
+    cache_dir = os.path.join(folder, PREVIEW_DIR)
+    cache_path = os.path.join(cache_dir, f"{attachment['sha256']}.v{PREVIEW_VERSION}.json")
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    previewer = PREVIEWERS.get(attachment['extension'])
+    if previewer is None:
+        raise PreviewError(f"No preview is available for .{attachment['extension']} files.")
+    try:
+        preview = previewer(os.path.join(folder, attachment['filename']))
+    except (ValueError, TypeError, UnicodeDecodeError, IndexError) as e:
+        raise PreviewError(f"Could not read {attachment['filename']}: {e}")
+    preview['filename'] = attachment['filename']
+    try:
+        # default=str covers anything a previewer missed, such as dates or decimals
+        encoded = json.dumps(preview, default=str)
+    except (TypeError, ValueError) as e:
+        raise PreviewError(f"Could not preview {attachment['filename']}: {e}")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(encoded)
+    os.replace(tmp_path, cache_path)
+    return json.loads(encoded)
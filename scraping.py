@@ -0,0 +1,337 @@
+"""
+Scrape bioRxiv, Broad news and MIA talks into posts, replacing the scrape_*.ipynb notebooks
+and the hand-merged *_post.tsv files:
+
+    python scraping.py [biorxiv] [broad_news] [mia_talks] [--limit N] [--workers N]
+
+Pages are fetched concurrently through fetching.Fetcher and its response cache (--replay
+runs offline from the cache alone), HTML is parsed in a process pool, and keywords are
+extracted with KeyBERT in batches across every source. Each document is remembered by URL and content hash in the
+scraped_documents table, so a re-run only extracts keywords for new or changed documents and
+only posts URLs it has not posted before. Posts and their authors are written to the app's
+database, and running app processes pick them up on their next request.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import types
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from fetching import CACHE_DIR, MAX_WORKERS, RECORD, REPLAY, REQUESTS_PER_SECOND, Fetcher
+from storage import DATABASE_PATH, SQLiteStorage
+
+logger = logging.getLogger(__name__)
+
+BROAD_URL = 'https://www.broadinstitute.org'
+BIORXIV_ENDPOINT = 'https://api.biorxiv.org/details/biorxiv/{start}/{end}/{cursor}/json'
+KEYBERT_MODEL = 'distilbert-base-nli-mean-tokens'
+KEYWORD_BATCH_SIZE = 64
+NEWS_BODY_RE = re.compile(r"clearfix text-formatted field field--name-field-text field--type-text-long field--label-hidden field__item")
+NEWS_SUMMARY_RE = re.compile(r"clearfix text-formatted field field--name-body field--type-text-with-summary field--label-hidden field__item")
+TALK_HEADERS_RE = re.compile(r'view-.*')
+
+
+def content_hash(document):
+    return hashlib.sha256(f"{document['title']}\n{document['body']}".encode()).hexdigest()
+
+
+# bioRxiv
+
+def biorxiv_documents(fetcher, limit=100, category='cancer biology', end_date=None):
+    """
+    Up to limit preprints in category, walking back a week at a time from end_date (today by
+    default) until a week has none.
+    """
+    end = datetime.strptime(end_date, '%Y-%m-%d') if end_date else datetime.now()
+    start = end - timedelta(days=7)
+    documents, seen = [], set()
+    cursor = 0
+    while len(documents) < limit:
+        # Each page's cursor depends on the previous one, so these are fetched one by one
+        text = fetcher.get(BIORXIV_ENDPOINT.format(start=start.strftime('%Y-%m-%d'), end=end.strftime('%Y-%m-%d'), cursor=cursor))
+        collection = json.loads(text)['collection'] if text else []
+        if not collection:
+            break
+        found = 0
+        for paper in collection:
+            if category not in paper['category'] or paper['doi'] in seen:
+                continue
+            seen.add(paper['doi'])
+            found += 1
+            documents.append({
+                'source': 'biorxiv',
+                'url': paper['jatsxml'],
+                'title': paper['title'],
+                'body': paper['abstract'].replace('\n', ' '),
+                'author': paper['author_corresponding'],
+                'date': paper['date'],
+                'license': paper['license'],
+                'tags': [paper['category']],
+            })
+        cursor += len(collection)
+        if not found:
+            # No more papers in this interval, move back a week
+            start, end, cursor = start - timedelta(days=7), start, 0
+    return documents[:limit]
+
+
+# Broad news
+
+def parse_news_article(page):
+    """
+    Title, author, date and text of a Broad news article page, or None if it has no text.
+    """
+    from bs4 import BeautifulSoup
+
+    url, html = page
+    soup = BeautifulSoup(html, 'html.parser')
+    try:
+        title = soup.find('div', class_='hero-section__title').span.h1.text.strip()
+        author = soup.find('div', class_='hero-section__author').div.text.strip()
+        date = datetime.strptime(soup.find('div', class_='hero-section__date').find('time').get('datetime'), '%Y-%m-%dT%H:%M:%S%z')
+    except AttributeError:
+        return None
+    body = soup.find('div', {'class': NEWS_BODY_RE})
+    if body is None:
+        body = next((text for text in soup.find_all('div', {'class': NEWS_SUMMARY_RE})
+                     if text.find('div', class_='summary-only') is None), None)
+    if body is None:
+        return None
+    return {
+        'source': 'broad_news',
+        'url': url,
+        'title': title,
+        'body': re.sub(r'\s+', ' ', body.text).strip(),
+        'author': re.sub(r'^\s*By\s+', '', author),
+        'date': date.strftime('%Y-%m-%d'),
+        'license': '',
+        'tags': ['broad', 'news'],
+    }
+
+
+def news_article_links(html):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+    return [BROAD_URL + link['href'] for link in soup.find_all('a', href=True) if link['href'].startswith('/news/')]
+
+
+def broad_news_pages(fetcher, limit=100):
+    """
+    (url, html) of the newest limit news articles, in listing order.
+    """
+    pages, seen = [], set()
+    page = 0
+    while len(pages) < limit:
+        listing = fetcher.get(f'{BROAD_URL}/news?page={page}')
+        links = list(dict.fromkeys(url for url in news_article_links(listing or '') if url not in seen))
+        if not links:
+            break
+        links = links[:limit - len(pages)]
+        seen.update(links)
+        pages += [(url, html) for url, html in zip(links, fetcher.get_many(links)) if html is not None]
+        page += 1
+    return pages
+
+
+# MIA talks
+
+def parse_talk_listing(html, year):
+    """
+    Date, speakers, title and link of every talk on a MIA season page.
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+    talks = [{}]
+    for cell in soup.find_all('td', {'headers': TALK_HEADERS_RE}):
+        header = cell.get('headers')[0]
+        if 'talks-date' in header:
+            talks[-1]['date'] = datetime.strptime(f'{cell.text.strip()} {year}', '%b %d %Y').strftime('%Y-%m-%d')
+        elif 'field-speaker' in header:
+            talks[-1]['speakers'] = [speaker.split('\n\n')[0] for speaker in cell.text.strip().split('\n\n\n \n')]
+        elif 'title' in header:
+            talks[-1]['title'] = cell.text.strip().rstrip('\n [Video]')
+            talks[-1]['link'] = BROAD_URL + cell.find('a').get('href')
+            talks.append({})
+    return [talk for talk in talks if 'link' in talk]
+
+
+def parse_talk(page):
+    """
+    A MIA talk as a document, from its listing entry and the html of its page, or None if the
+    page has no abstract.
+    """
+    from bs4 import BeautifulSoup
+
+    talk, html = page
+    abstract = BeautifulSoup(html, 'html.parser').find('div', class_='block block-layout-builder block-field-blocknodetalksbody')
+    if abstract is None:
+        return None
+    return {
+        'source': 'mia_talks',
+        'url': talk['link'],
+        'title': talk['title'],
+        'body': abstract.text.strip().replace('\n', ' '),
+        'author': ', '.join(talk.get('speakers', [])),
+        'date': talk.get('date', ''),
+        'license': '',
+        'tags': ['mia', 'meeting'],
+    }
+
+
+def mia_talk_pages(fetcher, first_year=2010, last_year=None):
+    """
+    (listing entry, html) of every MIA talk from first_year to last_year (this year by default).
+    """
+    seasons = [(season, year) for season in ['fall', 'spring'] for year in range(first_year, (last_year or datetime.now().year) + 1)]
+    listings = fetcher.get_many(f'{BROAD_URL}/talks/{season}-{year}/mia' for season, year in seasons)
+    talks = [talk for (_, year), listing in zip(seasons, listings) if listing is not None
+             for talk in parse_talk_listing(listing, year)]
+    return [(talk, html) for talk, html in zip(talks, fetcher.get_many(talk['link'] for talk in talks)) if html is not None]
+
+
+def collect(sources, fetcher, limit, workers, end_date=None):
+    """
+    Documents from every source. HTML pages are parsed in a pool of worker processes, as
+    BeautifulSoup is CPU-bound and single-threaded. end_date (YYYY-MM-DD, today by default)
+    is where bioRxiv and MIA scraping start looking back from, fix it to replay a recording.
+    """
+    documents = []
+    if 'biorxiv' in sources:
+        documents += biorxiv_documents(fetcher, limit, end_date=end_date)
+    pages = []
+    if 'broad_news' in sources:
+        pages += [(parse_news_article, page) for page in broad_news_pages(fetcher, limit)]
+    if 'mia_talks' in sources:
+        last_year = int(end_date[:4]) if end_date else None
+        pages += [(parse_talk, page) for page in mia_talk_pages(fetcher, last_year=last_year)]
+    if pages:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parsed = pool.map(_parse, pages, chunksize=8)
+            documents += [document for document in parsed if document is not None]
+    return documents
+
+
+def _parse(job):
+    parse, page = job
+    return parse(page)
+
+
+def extract_keywords(model, texts, batch_size=KEYWORD_BATCH_SIZE):
+    """
+    KeyBERT keywords of every text. Texts are embedded batch_size at a time instead of one
+    extract_keywords() call per text.
+    """
+    keywords = []
+    for i in range(0, len(texts), batch_size):
+        batch = texts[i:i + batch_size]
+        found = model.extract_keywords(batch)
+        # KeyBERT returns a flat list rather than a list of lists for a single document
+        if len(batch) == 1:
+            found = [found]
+        keywords += [[keyword for keyword, _ in pairs] for pairs in found]
+    return keywords
+
+
+def document_keywords(model, documents, batch_size=KEYWORD_BATCH_SIZE):
+    """
+    Keywords of every document, as its posts.tsv Keywords field: the title and body keywords
+    and the source's tags, with spaces inside a keyword turned into underscores.
+    """
+    title_keywords = extract_keywords(model, [document['title'] for document in documents], batch_size)
+    body_keywords = extract_keywords(model, [document['body'] for document in documents], batch_size)
+    return [
+        sorted({word.replace(' ', '_') for word in title + body}) + [tag.replace(' ', '_') for tag in document['tags']]
+        for document, title, body in zip(documents, title_keywords, body_keywords)
+    ]
+
+
+def _post(document, keywords):
+    return {
+        'title': document['title'],
+        'description': document['body'],
+        'keywords': keywords,
+        'dataset_type': '',
+        'collection_period': document['date'],
+        'organism': '',
+        'genes': '',
+        'tissue_celltype': '',
+        'condition': '',
+        'technique': '',
+        'instrument_platform': '',
+        'software': '',
+        'usage_restrictions': document['license'],
+        'related_datasets': '',
+        'link': document['url'],
+        'filename': None,
+        'user': document['author'],
+        'likes': 0,
+    }
+
+
+def ingest(storage, documents, model=None, batch_size=KEYWORD_BATCH_SIZE):
+    """
+    Post every document whose URL has not been posted yet, creating a user for authors the
+    site does not know. Keywords come from the scraped_documents cache when the content is
+    unchanged, otherwise from KeyBERT. Returns the number of posts created.
+    """
+    cache = storage.load_scraped_documents()
+    documents = list({document['url']: document for document in documents}.values())
+    new = [document for document in documents if cache.get(document['url'], {}).get('post_id') is None]
+    hashes = {document['url']: content_hash(document) for document in new}
+    stale = [document for document in new
+             if document['url'] not in cache or cache[document['url']]['content_hash'] != hashes[document['url']]]
+    logger.info("%d documents, %d not posted yet, %d need keywords", len(documents), len(new), len(stale))
+    if stale:
+        if model is None:
+            from keybert import KeyBERT
+
+            model = KeyBERT(KEYBERT_MODEL)
+        for document, keywords in zip(stale, document_keywords(model, stale, batch_size)):
+            cache[document['url']] = {'content_hash': hashes[document['url']], 'keywords': keywords, 'post_id': None}
+
+    users = {row['name'] for row in storage.load_users()}
+    with storage.batch():
+        for document in new:
+            if document['author'] not in users:
+                # No email, so nobody can log in as a scraped author
+                storage.insert_user(types.SimpleNamespace(
+                    id=None, name=document['author'], job_title='', email=None, department='', profile_picture=None,
+                    bio='', research_interests='', website=''))
+                users.add(document['author'])
+            entry = cache[document['url']]
+            entry['post_id'] = storage.insert_post(_post(document, entry['keywords']))
+            storage.save_scraped_document(document['url'], entry['content_hash'], entry['keywords'], entry['post_id'])
+    return len(new)
+
+
+SOURCES = ['biorxiv', 'broad_news', 'mia_talks']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scrape posts into the Broad Atlas database.')
+    parser.add_argument('sources', nargs='*', choices=SOURCES, default=SOURCES)
+    parser.add_argument('--db', default=DATABASE_PATH, help='SQLite database to write to')
+    parser.add_argument('--limit', type=int, default=100, help='bioRxiv papers and news articles to fetch')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes parsing HTML')
+    parser.add_argument('--batch-size', type=int, default=KEYWORD_BATCH_SIZE, help='documents per KeyBERT batch')
+    parser.add_argument('--end-date', help='YYYY-MM-DD to scrape back from, today by default')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='where HTTP responses are recorded')
+    parser.add_argument('--replay', action='store_true', help='serve every request from the cache, without network access')
+    parser.add_argument('--max-age', type=float, default=0, help='seconds a cached response is used without revalidating')
+    parser.add_argument('--concurrency', type=int, default=MAX_WORKERS, help='requests in flight')
+    parser.add_argument('--rate', type=float, default=REQUESTS_PER_SECOND, help='requests per second to each host')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    fetcher = Fetcher(args.cache_dir, REPLAY if args.replay else RECORD, max_age=args.max_age, rate=args.rate,
+                      max_workers=args.concurrency)
+    storage = SQLiteStorage(args.db)
+    storage.init_schema()
+    documents = collect(args.sources, fetcher, args.limit, args.workers, end_date=args.end_date)
+    print(f"Posted {ingest(storage, documents, batch_size=args.batch_size)} of {len(documents)} scraped documents")
+    print(f"HTTP: {fetcher.stats['fetched']} fetched, {fetcher.stats['revalidated']} not modified, {fetcher.stats['hits']} from cache")
@@ -0,0 +1,217 @@
+import math
+import re
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, defaultdict
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# Matches in the title count more than matches in the keywords, which count more than the description and comments
+FIELD_WEIGHTS = {'title': 3.0, 'keywords': 2.0, 'description': 1.0, 'comments': 1.0}
+# Structured post fields search results can be narrowed by, with the labels posts.tsv uses for them
+FACET_FIELDS = {
+    'dataset_type': 'Dataset Type',
+    'organism': 'Organism',
+    'technique': 'Technique',
+    'instrument_platform': 'Instrument Platform',
+    'software': 'Software',
+    'tissue_celltype': 'Tissue/Cell Type',
+    'usage_restrictions': 'Usage Restrictions',
+}
+# Values listed per facet, most frequent first, besides the ones already selected
+MAX_FACET_VALUES = 10
+# Shorter last query terms are matched as whole words rather than expanded as prefixes
+MIN_PREFIX_LENGTH = 3
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+def file_extension(filename):
+    if not filename or '.' not in filename:
+        return ''
+    return filename.rsplit('.', 1)[1].lower()
+
+
+def facet_value(post, field):
+    value = post.get(field)
+    return value.strip() if isinstance(value, str) else ''
+
+
+class SearchIndex:
+    """
+    Inverted index over post titles, descriptions, keywords and comment text.
+
+    Posting lists map a term to {post_id: weighted term frequency}. The search filters
+    (date, file type, author) are kept as their own lookup tables so a query never has
+    to scan every post.
+
+    Each facet field has its own posting lists, value -> set of post ids, updated as posts
+    are added. Selecting facet values intersects those sets with the matches, and the
+    counts shown next to each value are taken over the matching posts only.
+    """
+
+    def __init__(self, like_count=None):
+        # Post id -> number of likes, for sorting by popularity
+        self.like_count = like_count or (lambda post_id: self.posts[post_id]['likes'])
+        self.posts = {}
+        self.postings = defaultdict(Counter)
+        self.terms = []
+        self.by_extension = defaultdict(set)
+        self.by_author = defaultdict(set)
+        self.by_date = []
+        self.facets = {field: defaultdict(set) for field in FACET_FIELDS}
+        self.comment_counts = Counter()
+
+    def __len__(self):
+        return len(self.posts)
+
+    def _add_tokens(self, post_id, tokens, weight):
+        for token in tokens:
+            if token not in self.postings:
+                insort(self.terms, token)
+            self.postings[token][post_id] += weight
+
+    def add_post(self, post):
+        post_id = post['id']
+        self.posts[post_id] = post
+        self._add_tokens(post_id, tokenize(post['title']), FIELD_WEIGHTS['title'])
+        self._add_tokens(post_id, tokenize(' '.join(post['keywords'])), FIELD_WEIGHTS['keywords'])
+        self._add_tokens(post_id, tokenize(post['description']), FIELD_WEIGHTS['description'])
+        extension = file_extension(post.get('filename'))
+        if extension:
+            self.by_extension[extension].add(post_id)
+        self.by_author[post['user']].add(post_id)
+        if post.get('date'):
+            insort(self.by_date, (post['date'], post_id))
+        for field, postings in self.facets.items():
+            value = facet_value(post, field)
+            if value:
+                postings[value].add(post_id)
+
+    def add_comment(self, comment):
+        post_id = comment['post_id']
+        if post_id not in self.posts:
+            return
+        self._add_tokens(post_id, tokenize(comment['text']), FIELD_WEIGHTS['comments'])
+        self.comment_counts[post_id] += 1
+
+    def _expand(self, term, prefix=False):
+        # The term being typed, the last one, is taken as a prefix so 'gen' still finds 'genome'.
+        # Earlier terms and short prefixes only match whole words, which bounds the postings scanned
+        if not prefix or len(term) < MIN_PREFIX_LENGTH:
+            return [term] if term in self.postings else []
+        start = bisect_left(self.terms, term)
+        end = bisect_left(self.terms, term + '\uffff')
+        return self.terms[start:end]
+
+    def match(self, query):
+        """
+        Return {post_id: score} for every post matching any term of the query, scored with a
+        field-weighted tf-idf. An empty query matches every post, like the old substring search.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return dict.fromkeys(self.posts, 0.0)
+        n_posts = len(self.posts) or 1
+        scores = Counter()
+        for i, term in enumerate(terms):
+            for expanded in self._expand(term, prefix=i == len(terms) - 1):
+                postings = self.postings[expanded]
+                idf = math.log(1 + n_posts / len(postings))
+                for post_id, weight in postings.items():
+                    scores[post_id] += weight * idf
+        # A query such as 'csv' also matches posts by the extension of their attached file
+        for post_id in self.by_extension.get(query.strip().lower(), ()):
+            scores[post_id] += 1.0
+        return scores
+
+    def posts_between(self, start_date='', end_date=''):
+        lo = bisect_left(self.by_date, (start_date,)) if start_date else 0
+        hi = bisect_right(self.by_date, (end_date, float('inf'))) if end_date else len(self.by_date)
+        return {post_id for _, post_id in self.by_date[lo:hi]}
+
+    def posts_with_extension(self, extension):
+        return self.by_extension.get(extension.lstrip('.').lower(), set())
+
+    def posts_by_authors(self, names):
+        matched = set()
+        for name in names:
+            matched |= self.by_author.get(name, set())
+        return matched
+
+    def posts_by_author_substring(self, text):
+        return self.posts_by_authors(name for name in self.by_author if text in name.lower())
+
+    def posts_with_facet(self, field, values):
+        postings = self.facets[field]
+        if len(values) == 1:
+            return postings.get(values[0], set())
+        matched = set()
+        for value in values:
+            matched |= postings.get(value, set())
+        return matched
+
+    def _narrow(self, candidates, facets, skip=None):
+        # Smallest posting list first so the set shrinks early, a & b costs the size of the smaller set
+        for matched in sorted((self.posts_with_facet(field, values) for field, values in facets.items() if field != skip),
+                              key=len):
+            candidates = candidates & matched
+        return candidates
+
+    def facet_counts(self, candidates, facets, narrowed=None):
+        """
+        {field: [(value, count), ...]} over the candidate posts, most frequent first. The counts
+        for a field ignore the values selected for that same field, so picking one organism
+        still shows how many results the other organisms would give.
+        """
+        if narrowed is None:
+            narrowed = self._narrow(candidates, facets)
+        counts = {}
+        for field in FACET_FIELDS:
+            counted = self._narrow(candidates, facets, skip=field) if field in facets else narrowed
+            field_counts = Counter(facet_value(self.posts[post_id], field) for post_id in counted)
+            field_counts.pop('', None)
+            selected = facets.get(field, ())
+            ranked = sorted(field_counts.items(), key=lambda item: (-item[1], item[0]))
+            counts[field] = ranked[:MAX_FACET_VALUES] + [item for item in ranked[MAX_FACET_VALUES:] if item[0] in selected]
+        return counts
+
+    def _filter(self, query, start_date, end_date, file_type, authors, author_text):
+        scores = self.match(query)
+        candidates = set(scores)
+        if start_date or end_date:
+            candidates &= self.posts_between(start_date, end_date)
+        if file_type:
+            candidates &= self.posts_with_extension(file_type)
+        if authors is not None:
+            candidates &= self.posts_by_authors(authors)
+        if author_text:
+            candidates &= self.posts_by_author_substring(author_text)
+        return scores, candidates
+
+    def search(self, query, start_date='', end_date='', file_type='', authors=None, author_text='', sort='relevance', facets=None):
+        return self.faceted_search(query, start_date, end_date, file_type, authors, author_text, sort, facets, counts=False)[0]
+
+    def faceted_search(self, query, start_date='', end_date='', file_type='', authors=None, author_text='', sort='relevance',
+                       facets=None, counts=True):
+        """
+        Like search(), and also the facet counts over the results, see facet_counts(). facets
+        maps a field of FACET_FIELDS to the values selected for it: a post matches if it has
+        any of the values of every field.
+        """
+        facets = {field: list(values) for field, values in (facets or {}).items() if field in FACET_FIELDS and values}
+        scores, candidates = self._filter(query, start_date, end_date, file_type, authors, author_text)
+        narrowed = self._narrow(candidates, facets)
+        value_counts = self.facet_counts(candidates, facets, narrowed) if counts else None
+
+        results = [self.posts[post_id] for post_id in sorted(narrowed)]
+        if sort == 'popularity':
+            results.sort(key=lambda x: self.like_count(x['id']), reverse=True)
+        elif sort == 'comments':
+            results.sort(key=lambda x: self.comment_counts[x['id']], reverse=True)
+        elif sort == 'date':
+            results.sort(key=lambda x: x.get('date', ''), reverse=True)
+        else:
+            results.sort(key=lambda x: (-scores[x['id']], x['id']))
+        return results, value_counts
@@ -0,0 +1,89 @@
+import importlib
+import logging
+import os
+import sys
+import threading
+
+from instrumentation import span
+
+logger = logging.getLogger(__name__)
+
+# Where find_closest_posts and nearest_neighbours live, added to sys.path on first load
+MODULE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'misc_notebooks')
+
+
+class SimilarityUnavailable(Exception):
+    pass
+
+
+class SimilarityService:
+    """
+    Closest-posts graphs, with find_closest_posts and its gensim, pandas and embedding artifact
+    loaded lazily: by load(), or by the warm-up thread start() launches, which then keeps the
+    embeddings up to date with an EmbeddingUpdater. Until that is done, queries raise
+    SimilarityUnavailable instead of holding up the request, and importing the app stays fast.
+    """
+
+    def __init__(self, get_posts, get_post, interval=60, on_change=None):
+        self.get_posts = get_posts
+        self.get_post = get_post
+        self.interval = interval
+        self.on_change = on_change
+        self._module = None
+        self._updater = None
+        self._load_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._module is not None
+
+    def load(self):
+        """
+        Import find_closest_posts and load the embeddings, blocking until done.
+        """
+        with self._load_lock:
+            if self._module is None:
+                if MODULE_DIR not in sys.path:
+                    sys.path.append(MODULE_DIR)
+                module = importlib.import_module('find_closest_posts')
+                # Neighbours are resolved to the app's own post records, not a copy of the corpus
+                module.use_posts(self.get_post)
+                module.load_embeddings()
+                self._updater = module.EmbeddingUpdater(self.get_posts, self.interval, on_change=self.on_change)
+                self._module = module
+        return self._module
+
+    def _warm_up(self):
+        try:
+            self.load()
+        except Exception:
+            logger.exception("Could not load the closest-posts similarity")
+            with self._start_lock:
+                # Let the next query try again
+                self._thread = None
+            return
+        self._updater.start()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._warm_up, name='similarity-warm-up', daemon=True)
+                self._thread.start()
+
+    def notify(self):
+        if self._updater is not None:
+            self._updater.notify()
+
+    def closest_posts_graph(self, post_id):
+        if not self.ready:
+            self.start()
+            raise SimilarityUnavailable('Similar posts are still loading, try again shortly.')
+        try:
+            with span('similarity.graph'):
+                return self._module.get_closest_posts_graph(post_id=post_id)
+        except KeyError:
+            # A post is only in the neighbour index once the embedding updater has got to it
+            self._updater.notify()
+            raise SimilarityUnavailable('Similar posts are still being computed, try again shortly.')
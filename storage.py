@@ -0,0 +1,415 @@
+import argparse
+import contextlib
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+DATABASE_PATH = 'broad_atlas.db'
+
+USER_FIELDS = ['id', 'name', 'job_title', 'email', 'department', 'profile_picture', 'bio', 'research_interests', 'website']
+POST_FIELDS = ['id', 'title', 'description', 'keywords', 'dataset_type', 'collection_period', 'organism', 'genes',
+               'tissue_celltype', 'condition', 'technique', 'instrument_platform', 'software', 'usage_restrictions',
+               'related_datasets', 'link', 'filename', 'user', 'likes']
+ATTACHMENT_FIELDS = ['filename', 'size', 'extension', 'sha256', 'mime_type', 'mtime']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY, name TEXT, job_title TEXT, email TEXT, department TEXT, profile_picture TEXT,
+    bio TEXT, research_interests TEXT, website TEXT
+);
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE INDEX IF NOT EXISTS users_name ON users (name);
+
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY, title TEXT, description TEXT, keywords TEXT, dataset_type TEXT,
+    collection_period TEXT, organism TEXT, genes TEXT, tissue_celltype TEXT, condition TEXT, technique TEXT,
+    instrument_platform TEXT, software TEXT, usage_restrictions TEXT, related_datasets TEXT, link TEXT,
+    filename TEXT, user TEXT, likes INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS posts_user ON posts (user);
+
+CREATE TABLE IF NOT EXISTS comments (
+    id INTEGER PRIMARY KEY, post_id INTEGER NOT NULL, user TEXT, text TEXT
+);
+CREATE INDEX IF NOT EXISTS comments_post_id ON comments (post_id);
+
+CREATE TABLE IF NOT EXISTS likes (
+    post_id INTEGER NOT NULL, user TEXT NOT NULL, PRIMARY KEY (post_id, user)
+);
+CREATE INDEX IF NOT EXISTS likes_user ON likes (user);
+
+CREATE TABLE IF NOT EXISTS comment_likes (
+    comment_id INTEGER NOT NULL, user TEXT NOT NULL, PRIMARY KEY (comment_id, user)
+);
+
+CREATE TABLE IF NOT EXISTS follows (
+    follower_id TEXT NOT NULL, followee_id TEXT NOT NULL, PRIMARY KEY (follower_id, followee_id)
+);
+CREATE INDEX IF NOT EXISTS follows_followee ON follows (followee_id);
+
+CREATE TABLE IF NOT EXISTS downloads (
+    filename TEXT PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS attachments (
+    filename TEXT PRIMARY KEY, size INTEGER NOT NULL, extension TEXT, sha256 TEXT NOT NULL, mime_type TEXT,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS attachments_sha256 ON attachments (sha256);
+
+CREATE TABLE IF NOT EXISTS scraped_documents (
+    url TEXT PRIMARY KEY, content_hash TEXT NOT NULL, keywords TEXT NOT NULL, post_id INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS changes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, kind TEXT NOT NULL, payload TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS change_readers (
+    origin TEXT PRIMARY KEY, change_id INTEGER NOT NULL, seen REAL NOT NULL
+);
+"""
+
+INSERT_USER = f"INSERT OR REPLACE INTO users ({', '.join(USER_FIELDS)}) VALUES ({', '.join('?' * len(USER_FIELDS))})"
+# New users and posts get their ids from the database, so two processes can never hand out the same one
+INSERT_NEW_USER = f"""
+INSERT INTO users ({', '.join(USER_FIELDS)})
+VALUES ((SELECT COALESCE(MAX(CAST(id AS INTEGER)), 0) + 1 FROM users), {', '.join('?' * (len(USER_FIELDS) - 1))})
+"""
+SELECT_USER_ID = "SELECT id FROM users WHERE rowid = ?"
+INSERT_POST = f"INSERT OR REPLACE INTO posts ({', '.join(POST_FIELDS)}) VALUES ({', '.join('?' * len(POST_FIELDS))})"
+INSERT_COMMENT = "INSERT INTO comments (post_id, user, text) VALUES (?, ?, ?)"
+INSERT_LIKE = "INSERT OR IGNORE INTO likes (post_id, user) VALUES (?, ?)"
+UPDATE_POST_LIKES = "UPDATE posts SET likes = likes + ? WHERE id = ?"
+INSERT_COMMENT_LIKE = "INSERT OR IGNORE INTO comment_likes (comment_id, user) VALUES (?, ?)"
+INSERT_FOLLOW = "INSERT OR IGNORE INTO follows (follower_id, followee_id) VALUES (?, ?)"
+DELETE_FOLLOW = "DELETE FROM follows WHERE follower_id = ? AND followee_id = ?"
+INSERT_ATTACHMENT = f"INSERT OR REPLACE INTO attachments ({', '.join(ATTACHMENT_FIELDS)}) VALUES ({', '.join('?' * len(ATTACHMENT_FIELDS))})"
+DELETE_ATTACHMENT = "DELETE FROM attachments WHERE filename = ?"
+INCREMENT_DOWNLOADS = """
+INSERT INTO downloads (filename, count) VALUES (?, ?)
+ON CONFLICT (filename) DO UPDATE SET count = count + excluded.count
+"""
+INSERT_SCRAPED_DOCUMENT = "INSERT OR REPLACE INTO scraped_documents (url, content_hash, keywords, post_id) VALUES (?, ?, ?, ?)"
+INSERT_CHANGE = "INSERT INTO changes (origin, kind, payload) VALUES (?, ?, ?)"
+SELECT_CHANGES = "SELECT id, origin, kind, payload FROM changes WHERE id > ? ORDER BY id"
+REPORT_CHANGE_READER = """
+INSERT INTO change_readers (origin, change_id, seen) VALUES (?, ?, ?)
+ON CONFLICT (origin) DO UPDATE SET change_id = excluded.change_id, seen = excluded.seen
+"""
+# The newest change is always kept, last_change_id() reads it
+PRUNE_CHANGES = """
+DELETE FROM changes
+WHERE id <= (SELECT MIN(change_id) FROM change_readers) AND id < (SELECT MAX(id) FROM changes)
+"""
+
+
+class SQLiteStorage:
+    """
+    Durable storage for the Store, backed by a local SQLite database in WAL mode so several
+    worker processes can read while one writes.
+
+    Every thread gets its own long-lived connection. The SQL is kept in module-level
+    constants so sqlite3's statement cache re-uses the prepared statements. Writes commit
+    immediately unless they are made inside a batch() block, which groups them into one
+    transaction.
+
+    Every write also appends a row to the changes table in the same transaction, tagged with
+    the process that made it. Other processes replay those rows with changes_since() to keep
+    their in-memory copy current, and report how far they got with report_position(), so
+    prune_changes() can delete the rows every one of them has replayed.
+    """
+
+    def __init__(self, path=DATABASE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self.origin = secrets.token_hex(8)
+        # A forked worker must neither share its parent's connections nor its origin
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._local = threading.local()
+        self.origin = secrets.token_hex(8)
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.batch_depth = 0
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def init_schema(self):
+        with self.batch() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def batch(self):
+        conn = self.connection()
+        self._local.batch_depth += 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.batch_depth -= 1
+            if self._local.batch_depth == 0:
+                conn.rollback()
+            raise
+        self._local.batch_depth -= 1
+        if self._local.batch_depth == 0:
+            conn.commit()
+
+    def _write_many(self, sql, rows):
+        with self.batch() as conn:
+            conn.executemany(sql, rows)
+
+    def _log(self, conn, kind, payload):
+        conn.execute(INSERT_CHANGE, (self.origin, kind, json.dumps(payload)))
+
+    def is_empty(self):
+        row = self.connection().execute('SELECT (SELECT COUNT(*) FROM users) + (SELECT COUNT(*) FROM posts)').fetchone()
+        return row[0] == 0
+
+    # Writes
+
+    def insert_user(self, user):
+        """
+        Save a new user under the next free id, and return the id.
+        """
+        with self.batch() as conn:
+            rowid = conn.execute(INSERT_NEW_USER, [getattr(user, field) for field in USER_FIELDS[1:]]).lastrowid
+            user_id = conn.execute(SELECT_USER_ID, (rowid,)).fetchone()[0]
+            self._log(conn, 'user', dict(_user_row(user), id=user_id))
+        return user_id
+
+    def save_user(self, user):
+        with self.batch() as conn:
+            conn.execute(INSERT_USER, [getattr(user, field) for field in USER_FIELDS])
+            self._log(conn, 'user', _user_row(user))
+
+    def insert_post(self, post):
+        """
+        Save a new post under the next free id, and return the id.
+        """
+        with self.batch() as conn:
+            post_id = conn.execute(INSERT_POST, _post_row(dict(post, id=None))).lastrowid
+            self._log(conn, 'post', dict(post, id=post_id))
+        return post_id
+
+    def insert_comment(self, comment):
+        with self.batch() as conn:
+            comment_id = conn.execute(INSERT_COMMENT, (comment['post_id'], comment['user'], comment['text'])).lastrowid
+            self._log(conn, 'comment', dict(comment, id=comment_id))
+        return comment_id
+
+    def save_likes(self, likes):
+        """
+        Save (post_id, user) likes and add them to the posts' like counts. A like another
+        process saved first is skipped, so the counts stay equal to the number of likes.
+        """
+        with self.batch() as conn:
+            saved = [list(like) for like in likes if conn.execute(INSERT_LIKE, like).rowcount]
+            counts = Counter(post_id for post_id, _ in saved)
+            conn.executemany(UPDATE_POST_LIKES, [(n, post_id) for post_id, n in counts.items()])
+            if saved:
+                self._log(conn, 'likes', saved)
+
+    def save_comment_likes(self, likes):
+        with self.batch() as conn:
+            saved = [list(like) for like in likes if conn.execute(INSERT_COMMENT_LIKE, like).rowcount]
+            if saved:
+                self._log(conn, 'comment_likes', saved)
+
+    def save_follow(self, follower_id, followee_id):
+        with self.batch() as conn:
+            conn.execute(INSERT_FOLLOW, (follower_id, followee_id))
+            self._log(conn, 'follow', {'follower_id': follower_id, 'followee_id': followee_id})
+
+    def delete_follow(self, follower_id, followee_id):
+        with self.batch() as conn:
+            conn.execute(DELETE_FOLLOW, (follower_id, followee_id))
+            self._log(conn, 'unfollow', {'follower_id': follower_id, 'followee_id': followee_id})
+
+    def increment_downloads(self, filename, count=1):
+        self.increment_downloads_many({filename: count})
+
+    def increment_downloads_many(self, counts):
+        with self.batch() as conn:
+            conn.executemany(INCREMENT_DOWNLOADS, counts.items())
+            self._log(conn, 'downloads', counts)
+
+    def save_attachment(self, attachment):
+        with self.batch() as conn:
+            conn.execute(INSERT_ATTACHMENT, [attachment[field] for field in ATTACHMENT_FIELDS])
+            self._log(conn, 'attachment', {field: attachment[field] for field in ATTACHMENT_FIELDS})
+
+    def delete_attachment(self, filename):
+        with self.batch() as conn:
+            conn.execute(DELETE_ATTACHMENT, (filename,))
+            self._log(conn, 'forget_attachment', {'filename': filename})
+
+    def save_scraped_document(self, url, content_hash, keywords, post_id):
+        # Only scraping.py reads these, so they are not logged as changes
+        with self.batch() as conn:
+            conn.execute(INSERT_SCRAPED_DOCUMENT, (url, content_hash, ' '.join(keywords), post_id))
+
+    # Reads
+
+    def _rows(self, sql):
+        return [dict(row) for row in self.connection().execute(sql)]
+
+    def load_users(self):
+        return self._rows(f"SELECT {', '.join(USER_FIELDS)} FROM users ORDER BY CAST(id AS INTEGER)")
+
+    def load_posts(self):
+        posts = self._rows(f"SELECT {', '.join(POST_FIELDS)} FROM posts ORDER BY rowid")
+        for post in posts:
+            post['keywords'] = post['keywords'].split()
+        return posts
+
+    def load_comments(self):
+        return self._rows('SELECT id, post_id, user, text FROM comments ORDER BY id')
+
+    def load_likes(self):
+        return self._rows('SELECT post_id, user FROM likes ORDER BY rowid')
+
+    def load_comment_likes(self):
+        return self._rows('SELECT comment_id, user FROM comment_likes ORDER BY rowid')
+
+    def load_follows(self):
+        return self._rows('SELECT follower_id, followee_id FROM follows ORDER BY rowid')
+
+    def load_attachments(self):
+        return self._rows(f"SELECT {', '.join(ATTACHMENT_FIELDS)} FROM attachments")
+
+    def load_downloads(self):
+        return {row['filename']: row['count'] for row in self._rows('SELECT filename, count FROM downloads')}
+
+    def load_scraped_documents(self):
+        return {
+            row['url']: {'content_hash': row['content_hash'], 'keywords': row['keywords'].split(), 'post_id': row['post_id']}
+            for row in self._rows('SELECT url, content_hash, keywords, post_id FROM scraped_documents')
+        }
+
+    def last_change_id(self):
+        return self.connection().execute('SELECT COALESCE(MAX(id), 0) FROM changes').fetchone()[0]
+
+    def changes_since(self, change_id):
+        """
+        The id of the latest change, and (kind, payload) of the changes other processes made
+        after change_id, oldest first.
+        """
+        rows = self.connection().execute(SELECT_CHANGES, (change_id,)).fetchall()
+        last_id = rows[-1]['id'] if rows else change_id
+        return last_id, [(row['kind'], json.loads(row['payload'])) for row in rows if row['origin'] != self.origin]
+
+    def report_position(self, change_id):
+        with self.batch() as conn:
+            conn.execute(REPORT_CHANGE_READER, (self.origin, change_id, time.time()))
+
+    def prune_changes(self, max_age):
+        """
+        Delete the changes every process that reported its position in the last max_age seconds
+        has replayed, and return how many. Processes that stopped reporting are forgotten.
+        """
+        with self.batch() as conn:
+            conn.execute('DELETE FROM change_readers WHERE seen < ?', (time.time() - max_age,))
+            return conn.execute(PRUNE_CHANGES).rowcount
+
+
+def _user_row(user):
+    return {field: getattr(user, field) for field in USER_FIELDS}
+
+
+def _post_row(post):
+    values = dict(post, keywords=' '.join(post['keywords']))
+    return [values.get(field) for field in POST_FIELDS]
+
+
+def read_users_tsv(path):
+    users = []
+    with open(path, 'r') as f:
+        for i, line in enumerate(f):
+            if i == 0:
+                continue
+            name, job_title, email, department, profile_picture, bio, research_interests, website = line.rstrip('\n').split('\t')
+            users.append({
+                'id': str(i),
+                'name': name,
+                'job_title': job_title,
+                'email': email,
+                'department': department,
+                'profile_picture': profile_picture,
+                'bio': bio,
+                'research_interests': research_interests,
+                'website': website,
+            })
+    return users
+
+
+def read_posts_tsv(path):
+    posts = []
+    with open(path, 'r') as f:
+        for i, line in enumerate(f):
+            if i == 0:
+                continue
+            title, description, keywords, dataset_type, collection_period, organism, genes, tissue_celltype, condition, technique, instrument_platform, software, usage_restrictions, related_datasets, link, filename, user, post_id, post_likes = line.rstrip('\n').split('\t')
+            posts.append({
+                'title': title,
+                'description': description,
+                'keywords': keywords.split(),
+                'dataset_type': dataset_type,
+                'collection_period': collection_period,
+                'organism': organism,
+                'genes': genes,
+                'tissue_celltype': tissue_celltype,
+                'condition': condition,
+                'technique': technique,
+                'instrument_platform': instrument_platform,
+                'software': software,
+                'usage_restrictions': usage_restrictions,
+                'related_datasets': related_datasets,
+                'link': link,
+                'filename': filename or None,
+                'user': user,
+                'id': int(post_id),
+                'likes': int(post_likes)
+            })
+    return posts
+
+
+def import_tsv(storage, posts_path='posts.tsv', users_path='users.tsv'):
+    """
+    One-shot import of the legacy posts.tsv and users.tsv files, in a single transaction.
+    """
+    users = read_users_tsv(users_path)
+    posts = read_posts_tsv(posts_path)
+    with storage.batch():
+        storage._write_many(INSERT_USER, [[user[field] for field in USER_FIELDS] for user in users])
+        storage._write_many(INSERT_POST, [_post_row(post) for post in posts])
+    return len(users), len(posts)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the Broad Atlas database.')
+    parser.add_argument('command', choices=['import'])
+    parser.add_argument('--db', default=DATABASE_PATH, help='SQLite database to write to')
+    parser.add_argument('--posts', default='posts.tsv')
+    parser.add_argument('--users', default='users.tsv')
+    args = parser.parse_args()
+    storage = SQLiteStorage(args.db)
+    storage.init_schema()
+    n_users, n_posts = import_tsv(storage, args.posts, args.users)
+    print(f"Imported {n_users} users and {n_posts} posts into {args.db}")
@@ -0,0 +1,417 @@
+import logging
+import threading
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+
+from counters import BatchedCounter
+from posts import Post
+from timelines import Timelines
+
+logger = logging.getLogger(__name__)
+
+
+def _claim(index, key):
+    # setdefault is atomic, so when two threads add the same key only one gets its own marker back
+    marker = object()
+    return index.setdefault(key, marker) is marker
+
+
+class Store:
+    """
+    In-memory posts, comments, likes and users, indexed so every route lookup is a dict or
+    set access rather than a scan over the whole site history.
+
+    posts (posts.Post records) and comments are dicts keyed by id in creation order. Likes
+    are (post_id, user) and (comment_id, user) sets, with per-post comment lists and per-user
+    post and like lists kept alongside. Users' followers and following are sets of ids, and
+    timelines holds each user's home timeline of posts by the users they follow.
+
+    If a backend (see storage.SQLiteStorage) is given, every change is written through to
+    it and load() restores the store from it. New users, posts and comments then get their
+    ids from the backend. When several processes share one backend, sync() replays the
+    changes the others made since this store last looked.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.users = {}
+        # email and name -> ids of the users with it, lowest id first, like the old scans found them
+        self.users_by_email = defaultdict(list)
+        self.users_by_name = defaultdict(list)
+        # Lowercased department -> ids of its users, for the search filter
+        self.users_by_department = defaultdict(list)
+        self.posts = {}
+        self.post_ids = []
+        self.comments = {}
+        self.post_comments = defaultdict(list)
+        self.user_posts = defaultdict(list)
+        # (post_id, user) and (comment_id, user) likes, dicts so a like is claimed atomically, see _claim
+        self.likes = {}
+        self.user_likes = defaultdict(list)
+        self.comment_likes = {}
+        # Post like counts (post['likes']), comment like counts and download counts hold what was
+        # loaded from the backend or synced from other processes. This process's own increments
+        # go to lock-free BatchedCounters that are merged in on read, e.g. like_count(), and
+        # written to the backend in batches with the likes themselves, see start_counters()
+        self.comment_like_counts = Counter()
+        self.downloads = Counter()
+        self.like_counter = BatchedCounter()
+        self.comment_like_counter = BatchedCounter()
+        self.download_counter = BatchedCounter(backend.increment_downloads_many if backend else None)
+        # Each new like is counted once under its (id, user) key, flushing them saves the likes
+        self.like_writes = BatchedCounter(backend.save_likes if backend else None)
+        self.comment_like_writes = BatchedCounter(backend.save_comment_likes if backend else None)
+        self.attachments = {}
+        self.attachments_by_hash = {}
+        self.timelines = Timelines(self.posts_by_id, lambda user_id: self.users[user_id].following,
+                                   lambda user_id: self.users[user_id].followers)
+        self.make_user = None
+        self.last_change_id = 0
+        self._sync_lock = threading.Lock()
+
+    def load(self, make_user):
+        """
+        Fill the store from the backend. make_user builds a user object from a users row.
+        """
+        self.make_user = make_user
+        # Read before the tables, so a change made while loading is replayed rather than missed,
+        # and reported at once so no other process prunes those changes before they are replayed
+        self.last_change_id = self.backend.last_change_id()
+        self.backend.report_position(self.last_change_id)
+        for row in self.backend.load_users():
+            self._index_user(make_user(**row))
+        for post in self.backend.load_posts():
+            self._index_post(Post(**post))
+        for comment in self.backend.load_comments():
+            self._add_comment(comment)
+        for like in self.backend.load_likes():
+            # Counted in post['likes'] already
+            self._like_post(like['post_id'], like['user'])
+        for like in self.backend.load_comment_likes():
+            if self._like_comment(like['comment_id'], like['user']):
+                self.comment_like_counts[like['comment_id']] += 1
+        for follow in self.backend.load_follows():
+            self._follow(follow['follower_id'], follow['followee_id'])
+        self.downloads.update(self.backend.load_downloads())
+        for attachment in self.backend.load_attachments():
+            self._record_attachment(attachment)
+
+    def sync(self):
+        """
+        Apply the changes other processes wrote to the backend since the last sync, and return
+        them as (kind, item) pairs, e.g. ('post', post), for callers keeping their own indexes.
+        """
+        with self._sync_lock:
+            last_id, changes = self.backend.changes_since(self.last_change_id)
+            applied = [(kind, self._apply(kind, payload)) for kind, payload in changes]
+            self.last_change_id = last_id
+        return [(kind, item) for kind, item in applied if item is not None]
+
+    def _apply(self, kind, payload):
+        if kind == 'user':
+            user = self.users.get(payload['id'])
+            if user is None:
+                user = self.make_user(**payload)
+                self._index_user(user)
+            else:
+                self._update_user(user, payload)
+            return user
+        if kind == 'post':
+            if payload['id'] in self.posts:
+                return None
+            post = Post(**payload)
+            self._index_post(post)
+            return post
+        if kind == 'comment':
+            if payload['id'] in self.comments:
+                return None
+            self._add_comment(payload)
+            return payload
+        if kind == 'likes':
+            for post_id, user_name in payload:
+                if self._like_post(post_id, user_name):
+                    self.posts[post_id]['likes'] += 1
+            return payload
+        if kind == 'comment_likes':
+            for comment_id, user_name in payload:
+                if self._like_comment(comment_id, user_name):
+                    self.comment_like_counts[comment_id] += 1
+            return payload
+        if kind == 'follow':
+            return payload if self._follow(payload['follower_id'], payload['followee_id']) else None
+        if kind == 'unfollow':
+            return payload if self._unfollow(payload['follower_id'], payload['followee_id']) else None
+        if kind == 'downloads':
+            self.downloads.update(payload)
+            return payload
+        if kind == 'attachment':
+            self._record_attachment(payload)
+            return payload
+        if kind == 'forget_attachment':
+            self._forget_attachment(payload['filename'])
+            return payload
+        raise ValueError(f'Unknown change {kind!r}')
+
+    def next_user_id(self):
+        return str(max(map(int, self.users), default=0) + 1)
+
+    def _user_keys(self, user):
+        return ((self.users_by_email, user.email), (self.users_by_name, user.name),
+                (self.users_by_department, (user.department or '').lower()))
+
+    def _index_user(self, user):
+        self.users[user.id] = user
+        for index, key in self._user_keys(user):
+            # Users without an email, e.g. scraped authors, cannot be found by one
+            if index is not self.users_by_name and not (key or '').strip():
+                continue
+            index[key].append(user.id)
+            index[key].sort(key=int)
+
+    def _unindex_user(self, user):
+        for index, key in self._user_keys(user):
+            ids = index.get(key, [])
+            if user.id in ids:
+                ids.remove(user.id)
+            if not ids:
+                index.pop(key, None)
+
+    def add_user(self, user):
+        if self.backend:
+            user.id = self.backend.insert_user(user)
+        self._index_user(user)
+        return user
+
+    def _update_user(self, user, fields):
+        self._unindex_user(user)
+        for field, value in fields.items():
+            setattr(user, field, value)
+        self._index_user(user)
+
+    def update_user(self, user, **fields):
+        """
+        Change a user's profile fields, keeping the email, name and department indexes in step.
+        """
+        self._update_user(user, fields)
+        if self.backend:
+            self.backend.save_user(user)
+
+    def user_by_email(self, email):
+        if not (email or '').strip():
+            return None
+        ids = self.users_by_email.get(email)
+        return self.users[ids[0]] if ids else None
+
+    def authors_in_department(self, department):
+        """
+        Names of the users in a department, compared case-insensitively.
+        """
+        return {self.users[user_id].name for user_id in self.users_by_department.get(department.lower(), ())}
+
+    def user_id_for_name(self, name):
+        ids = self.users_by_name.get(name)
+        return ids[0] if ids else None
+
+    def _follow(self, follower_id, followee_id):
+        follower, followee = self.users.get(follower_id), self.users.get(followee_id)
+        if follower is None or followee is None or followee_id in follower.following:
+            return False
+        follower.following.add(followee_id)
+        followee.followers.add(follower_id)
+        self.timelines.invalidate(follower_id)
+        return True
+
+    def follow(self, follower_id, followee_id):
+        if not self._follow(follower_id, followee_id):
+            return False
+        if self.backend:
+            self.backend.save_follow(follower_id, followee_id)
+        return True
+
+    def _unfollow(self, follower_id, followee_id):
+        follower, followee = self.users.get(follower_id), self.users.get(followee_id)
+        if follower is None or followee is None or followee_id not in follower.following:
+            return False
+        follower.following.discard(followee_id)
+        followee.followers.discard(follower_id)
+        self.timelines.invalidate(follower_id)
+        return True
+
+    def unfollow(self, follower_id, followee_id):
+        if not self._unfollow(follower_id, followee_id):
+            return False
+        if self.backend:
+            self.backend.delete_follow(follower_id, followee_id)
+        return True
+
+    def start_counters(self):
+        for counter in (self.download_counter, self.like_writes, self.comment_like_writes):
+            counter.start()
+
+    def record_download(self, filename):
+        self.download_counter.increment(filename)
+
+    def download_count(self, filename):
+        return self.downloads[filename] + self.download_counter.count(filename)
+
+    def _record_attachment(self, attachment):
+        self.attachments[attachment['filename']] = attachment
+        self.attachments_by_hash.setdefault(attachment['sha256'], attachment)
+
+    def record_attachment(self, attachment):
+        self._record_attachment(attachment)
+        if self.backend:
+            self.backend.save_attachment(attachment)
+
+    def _forget_attachment(self, filename):
+        attachment = self.attachments.pop(filename, None)
+        if attachment is None:
+            return False
+        if self.attachments_by_hash.get(attachment['sha256']) is attachment:
+            del self.attachments_by_hash[attachment['sha256']]
+        return True
+
+    def forget_attachment(self, filename):
+        if self._forget_attachment(filename) and self.backend:
+            self.backend.delete_attachment(filename)
+
+    def attachment_by_hash(self, sha256):
+        return self.attachments_by_hash.get(sha256)
+
+    def next_post_id(self):
+        return max(self.posts, default=0) + 1
+
+    def _index_post(self, post):
+        self.posts[post['id']] = post
+        insort(self.post_ids, post['id'])
+        self.user_posts[post['user']].append(post)
+        self.timelines.add_post(post, self.user_id_for_name(post['user']))
+
+    def add_post(self, post):
+        post = Post(**post)
+        post['id'] = self.backend.insert_post(post) if self.backend else self.next_post_id()
+        self._index_post(post)
+        return post
+
+    def get_post(self, post_id):
+        return self.posts.get(post_id)
+
+    def all_posts(self):
+        return list(self.posts.values())
+
+    def page_posts(self, before=None, limit=20):
+        """
+        Keyset pagination over posts, newest first: up to limit posts with an id below before
+        (or the newest posts if before is None), and the cursor for the next page or None.
+        """
+        end = len(self.post_ids) if before is None else bisect_left(self.post_ids, before)
+        start = max(0, end - limit)
+        page = [self.posts[post_id] for post_id in reversed(self.post_ids[start:end])]
+        next_cursor = page[-1]['id'] if start > 0 else None
+        return page, next_cursor
+
+    def posts_by(self, user_name):
+        return self.user_posts.get(user_name, [])
+
+    def posts_by_id(self, user_id):
+        user = self.users.get(user_id)
+        return self.posts_by(user.name) if user else []
+
+    def timeline(self, user_id, before=None, limit=20):
+        return self.timelines.page(user_id, before, limit)
+
+    def _add_comment(self, comment):
+        self.comments[comment['id']] = comment
+        self.post_comments[comment['post_id']].append(comment)
+
+    def add_comment(self, post_id, user_name, text):
+        comment = {'post_id': post_id, 'user': user_name, 'text': text}
+        comment['id'] = self.backend.insert_comment(comment) if self.backend else max(self.comments, default=0) + 1
+        self._add_comment(comment)
+        return comment
+
+    def comments_for(self, post_id):
+        return self.post_comments.get(post_id, [])
+
+    def _like_post(self, post_id, user_name):
+        if post_id not in self.posts or not _claim(self.likes, (post_id, user_name)):
+            return False
+        self.user_likes[user_name].append(post_id)
+        return True
+
+    def like_post(self, post_id, user_name):
+        """
+        Record a like, returning False if the user had already liked the post.
+        """
+        if not self._like_post(post_id, user_name):
+            return False
+        self.like_counter.increment(post_id)
+        self.like_writes.increment((post_id, user_name))
+        return True
+
+    def like_count(self, post_id):
+        return self.posts[post_id]['likes'] + self.like_counter.count(post_id)
+
+    def has_liked(self, post_id, user_name):
+        return (post_id, user_name) in self.likes
+
+    def liked_posts(self, user_name):
+        return [self.posts[post_id] for post_id in self.user_likes.get(user_name, [])]
+
+    def _like_comment(self, comment_id, user_name):
+        return comment_id in self.comments and _claim(self.comment_likes, (comment_id, user_name))
+
+    def like_comment(self, comment_id, user_name):
+        if not self._like_comment(comment_id, user_name):
+            return False
+        self.comment_like_counter.increment(comment_id)
+        self.comment_like_writes.increment((comment_id, user_name))
+        return True
+
+    def has_liked_comment(self, comment_id, user_name):
+        return (comment_id, user_name) in self.comment_likes
+
+    def comment_like_count(self, comment_id):
+        return self.comment_like_counts[comment_id] + self.comment_like_counter.count(comment_id)
+
+
+class ChangeLogPruner:
+    """
+    Keeps the backend's changes table from growing forever. Every interval seconds it reports
+    how far the store has synced and deletes the changes every live process has replayed. A
+    process that has not reported for max_age seconds is taken to have exited and no longer
+    holds the pruning back.
+    """
+
+    def __init__(self, store, interval=60, max_age=600):
+        self.store = store
+        self.interval = interval
+        self.max_age = max_age
+        self._stop = threading.Event()
+        self._thread = None
+
+    def report(self):
+        self.store.backend.report_position(self.store.last_change_id)
+
+    def prune(self):
+        self.report()
+        deleted = self.store.backend.prune_changes(self.max_age)
+        if deleted:
+            logger.info("Pruned %d replayed changes", deleted)
+
+    def _run(self):
+        while True:
+            try:
+                self.prune()
+            except Exception:
+                logger.exception("Could not prune the change log")
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='change-log-pruner', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
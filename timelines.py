@@ -0,0 +1,94 @@
+import threading
+from collections import deque
+from heapq import merge
+from itertools import islice
+
+# Newest posts kept per home timeline, older ones are only on /posts
+TIMELINE_LENGTH = 500
+# Posts by users with more followers than this are not copied into every follower's timeline,
+# they are merged in when a timeline is read
+FANOUT_MAX_FOLLOWERS = 1000
+
+
+class Timelines:
+    """
+    Home timelines: for each user, the newest posts by the users they follow, newest first.
+
+    A timeline is built the first time it is read, from the followed users' posts. After that
+    a new post is pushed onto the bounded timeline of each follower of its author (fan-out on
+    write), so reading the home page slices a ready list. Authors with many followers are
+    the exception: their posts are merged into a timeline when it is read, so one upload does
+    not touch thousands of timelines.
+
+    posts_by(user_id) returns a user's posts, oldest first, and following(user_id) and
+    followers(user_id) the ids of the users they follow and are followed by.
+    """
+
+    def __init__(self, posts_by, following, followers, length=TIMELINE_LENGTH, fanout_max_followers=FANOUT_MAX_FOLLOWERS):
+        self.posts_by = posts_by
+        self.following = following
+        self.followers = followers
+        self.length = length
+        self.fanout_max_followers = fanout_max_followers
+        self._timelines = {}
+        self._lock = threading.Lock()
+
+    def _fans_out(self, author_id):
+        return len(self.followers(author_id)) <= self.fanout_max_followers
+
+    def _newest(self, posts):
+        return islice(reversed(posts), self.length)
+
+    def _build(self, user_id):
+        authors = [author_id for author_id in self.following(user_id) if self._fans_out(author_id)]
+        newest = merge(*(self._newest(self.posts_by(author_id)) for author_id in authors),
+                       key=lambda post: post['id'], reverse=True)
+        return deque(islice(newest, self.length), maxlen=self.length)
+
+    def add_post(self, post, author_id):
+        if author_id is None or not self._fans_out(author_id):
+            return
+        with self._lock:
+            for follower_id in self.followers(author_id):
+                timeline = self._timelines.get(follower_id)
+                if timeline is None:
+                    continue
+                if timeline and timeline[0]['id'] > post['id']:
+                    # Posts synced from another worker can arrive out of order, rebuild rather than sort
+                    del self._timelines[follower_id]
+                else:
+                    timeline.appendleft(post)
+
+    def invalidate(self, user_id):
+        """
+        Drop a user's timeline after they follow or unfollow someone, it is rebuilt on next read.
+        """
+        with self._lock:
+            self._timelines.pop(user_id, None)
+
+    def page(self, user_id, before=None, limit=20):
+        """
+        Up to limit timeline posts with an id below before (or the newest if before is None),
+        and the cursor for the next page or None, like Store.page_posts.
+        """
+        with self._lock:
+            timeline = self._timelines.get(user_id)
+            if timeline is None:
+                timeline = self._timelines[user_id] = self._build(user_id)
+            timeline = list(timeline)
+        merged_in = [self._newest(self.posts_by(author_id)) for author_id in self.following(user_id)
+                     if not self._fans_out(author_id)]
+        if merged_in:
+            merged = []
+            for post in merge(timeline, *merged_in, key=lambda post: post['id'], reverse=True):
+                # An author who crossed fanout_max_followers can have posts in both
+                if not merged or merged[-1]['id'] != post['id']:
+                    merged.append(post)
+                if len(merged) == self.length:
+                    break
+            timeline = merged
+        if before is not None:
+            timeline = [post for post in timeline if post['id'] < before]
+        page = timeline[:limit]
+        next_cursor = page[-1]['id'] if len(timeline) > limit else None
+        return page, next_cursor
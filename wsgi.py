@@ -0,0 +1,20 @@
+"""
+Production entry point, run with gunicorn from the repository root:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app, its data and the post embeddings are loaded once here, in the gunicorn master,
+and the forked workers share them copy-on-write. See gunicorn.conf.py for the worker setup.
+"""
+import logging
+
+from app import app, make_files, similarity
+
+logger = logging.getLogger(__name__)
+
+make_files()
+try:
+    similarity.load()
+except Exception:
+    # Posts still work without embeddings, only the closest-posts graph needs them
+    logger.exception("Could not load the post embeddings")